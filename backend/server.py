@@ -1,33 +1,215 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header, Response, Request
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
-from datetime import datetime, timezone
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from datetime import datetime, timezone, timedelta
+from pymongo import ReturnDocument, CursorType, monitoring
+from pymongo.errors import CollectionInvalid
 import json
+import re
+import threading
+import hashlib
 import asyncio
+import socket
+import time
+import zlib
+import string
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Счетчики пула соединений MongoDB для /api/readyz"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.checkout_failures = 0
+    
+    def _add(self, field: str, delta: int):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + delta)
+    
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"open": self.open, "in_use": self.in_use, "checkout_failures": self.checkout_failures}
+    
+    def connection_created(self, event):
+        self._add('open', 1)
+    
+    def connection_closed(self, event):
+        self._add('open', -1)
+    
+    def connection_checked_out(self, event):
+        self._add('in_use', 1)
+    
+    def connection_checked_in(self, event):
+        self._add('in_use', -1)
+    
+    def connection_check_out_failed(self, event):
+        self._add('checkout_failures', 1)
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_check_out_started(self, event):
+        pass
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+# MongoDB connection: параметры пула из окружения, незаданные - по умолчанию драйвера
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+mongo_pool_options = {
+    key: value for key, value in {
+        "maxPoolSize": _env_int('MONGO_MAX_POOL_SIZE'),
+        "minPoolSize": _env_int('MONGO_MIN_POOL_SIZE'),
+        "maxIdleTimeMS": _env_int('MONGO_MAX_IDLE_TIME_MS'),
+        "waitQueueTimeoutMS": _env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        "connectTimeoutMS": _env_int('MONGO_CONNECT_TIMEOUT_MS'),
+        "serverSelectionTimeoutMS": _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        "socketTimeoutMS": _env_int('MONGO_SOCKET_TIMEOUT_MS')
+    }.items() if value is not None
+}
+pool_monitor = PoolMonitor()
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_monitor], **mongo_pool_options)
 db = client[os.environ['DB_NAME']]
 
+# Готовность процесса: прогрев пула и проверка MongoDB при старте
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+STARTUP_RETRY_DELAY = float(os.environ.get('STARTUP_RETRY_DELAY', '2'))
+
+# Очередь фоновых задач
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1.0'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '4'))
+RUN_EMBEDDED_WORKER = os.environ.get('RUN_EMBEDDED_WORKER', 'true').lower() == 'true'
+
+# События Socket.IO между процессами (API и выделенные воркеры) через capped-коллекцию MongoDB.
+# В API по умолчанию включено, если задачи выполняются вне API-процесса; worker.py включает всегда
+SOCKETIO_MONGO_QUEUE = os.environ.get('SOCKETIO_MONGO_QUEUE', str(not RUN_EMBEDDED_WORKER)).lower() == 'true'
+SOCKETIO_QUEUE_SIZE_BYTES = int(os.environ.get('SOCKETIO_QUEUE_SIZE_BYTES', str(64 * 1024 * 1024)))
+
+# Поиск по коду: файлы с большим числом уникальных триграмм не индексируются и сканируются целиком
+SEARCH_MAX_TRIGRAMS = int(os.environ.get('SEARCH_MAX_TRIGRAMS', '50000'))
+SEARCH_SNIPPET_LENGTH = 200
+
+# Сжатие содержимого больших файлов при хранении
+FILE_COMPRESSION_THRESHOLD = int(os.environ.get('FILE_COMPRESSION_THRESHOLD', '32768'))
+FILE_COMPRESSION_LEVEL = int(os.environ.get('FILE_COMPRESSION_LEVEL', '6'))
+
+# Контекст для агента исправления: окно строк вокруг ошибки
+FIX_CONTEXT_LINES = int(os.environ.get('FIX_CONTEXT_LINES', '30'))
+FIX_WHOLE_FILE_LINES = int(os.environ.get('FIX_WHOLE_FILE_LINES', '120'))
+FIX_MAX_DEFINITIONS = 3
+FIX_DEFINITION_LINES = 15
+
+# Параллельная генерация файлов после планирования
+GENERATION_CONCURRENCY = int(os.environ.get('GENERATION_CONCURRENCY', '4'))
+
+# Кеш статистики дашборда
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', '10'))
+
+# События проекта (логи и статус) для SSE. События воркеров из других процессов приходят
+# через ту же очередь, что и Socket.IO (SOCKETIO_MONGO_QUEUE). Альтернатива - change streams MongoDB,
+# они требуют replica set: без него API не станет готов (см. /api/readyz)
+EVENTS_FROM_CHANGE_STREAM = os.environ.get('EVENTS_FROM_CHANGE_STREAM', 'false').lower() == 'true'
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_QUEUE_SIZE = 1000
+
+# Фоновое удаление проектов: дочерние документы удаляются пачками
+REAP_BATCH_SIZE = int(os.environ.get('REAP_BATCH_SIZE', '500'))
+REAP_BATCH_DELAY = float(os.environ.get('REAP_BATCH_DELAY', '0.2'))
+# agent_calls не вычищаются: по ним считаются метрики и стоимость агентов (/api/agents/metrics)
+REAP_COLLECTIONS = ("files", "search_index", "logs", "versions", "test_results", "jobs")
+
+# Удаленные проекты остаются надгробиями (deleted=True), пока их не вычистит фоновая задача
+LIVE_PROJECT = {"deleted": {"$ne": True}}
+
+class AsyncMongoManager(AsyncPubSubManager):
+    """Менеджер клиентов Socket.IO, рассылающий события между процессами
+    через capped-коллекцию MongoDB и tailable cursor (replica set не нужен)"""
+    
+    name = 'asyncmongo'
+    
+    def __init__(self, collection, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.collection = collection
+    
+    async def _handle_emit(self, message):
+        await super()._handle_emit(message)
+        
+        # События своего процесса уже переданы подписчикам SSE при отправке
+        if message.get('host_id') != self.host_id:
+            relay_project_event(message.get('event'), message.get('room'), message.get('data'))
+    
+    async def _publish(self, data):
+        await self.collection.insert_one({"channel": self.channel, "message": json.dumps(data, default=str)})
+    
+    async def _listen(self):
+        # Читаем только новые сообщения, начиная с последнего на момент подключения
+        latest = await self.collection.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = latest['_id'] if latest else None
+        
+        while True:
+            query: Dict[str, Any] = {"channel": self.channel}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            
+            try:
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        last_id = doc['_id']
+                        yield doc['message']
+            except Exception:
+                logger.exception("Ошибка чтения очереди событий Socket.IO")
+            
+            # Курсор закрывается на пустой коллекции и после ошибок - переоткрываем
+            await asyncio.sleep(1)
+
+async def ensure_socketio_queue():
+    """Создать capped-коллекцию для событий Socket.IO (tailable cursor работает только с ней)"""
+    if not SOCKETIO_MONGO_QUEUE:
+        return
+    
+    if "socketio_events" not in await db.list_collection_names(filter={"name": "socketio_events"}):
+        try:
+            await db.create_collection("socketio_events", capped=True, size=SOCKETIO_QUEUE_SIZE_BYTES)
+        except CollectionInvalid:
+            pass  # создана другим процессом
+
 # Socket.IO setup
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins='*',
     logger=True,
-    engineio_logger=False
+    engineio_logger=False,
+    client_manager=AsyncMongoManager(db.socketio_events) if SOCKETIO_MONGO_QUEUE else None
 )
 
 # Create the main app
@@ -54,6 +236,7 @@ class Project(BaseModel):
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     files_count: int = 0
     github_url: Optional[str] = None
+    version: int = 1
 
 class ProjectCreate(BaseModel):
     prompt: str
@@ -66,6 +249,9 @@ class FileItem(BaseModel):
     path: str
     content: str
     language: str = "text"
+    size: int = 0
+    compressed_size: Optional[int] = None
+    version: int = 1
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -77,6 +263,25 @@ class FileCreate(BaseModel):
 class FileUpdate(BaseModel):
     content: str
 
+# Смещения start/end - в кодовых единицах UTF-16, как индексы строк JavaScript в браузере
+class TextEdit(BaseModel):
+    start: int
+    end: int
+    text: str = ""
+
+class FilePatch(BaseModel):
+    base_version: int
+    edits: Optional[List[TextEdit]] = None
+    diff: Optional[str] = None
+
+class FilePatchResult(BaseModel):
+    id: str
+    path: str
+    version: int
+    size: int
+    compressed_size: Optional[int] = None
+    updated_at: datetime
+
 class Version(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
@@ -100,6 +305,7 @@ class LogEntry(BaseModel):
     level: str
     message: str
     details: Optional[Dict[str, Any]] = None
+    seq: Optional[int] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class LogCreate(BaseModel):
@@ -109,15 +315,54 @@ class LogCreate(BaseModel):
     details: Optional[Dict[str, Any]] = None
 
 class AgentConfig(BaseModel):
-    model_config = ConfigDict(extra="ignore")
+    model_config = ConfigDict(extra="ignore", protected_namespaces=())
     
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
-    prompt_template: str
+    prompt_template: str = ""
     model_provider: str = "openai"
     model_name: str = "gpt-4o"
     enabled: bool = True
+    cost_per_1k_input: float = 0
+    cost_per_1k_output: float = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class AgentConfigCreate(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    
+    name: str
+    prompt_template: str = ""
+    model_provider: str = "openai"
+    model_name: str = "gpt-4o"
+    enabled: bool = True
+    cost_per_1k_input: float = 0
+    cost_per_1k_output: float = 0
+
+class AgentConfigUpdate(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    
+    prompt_template: Optional[str] = None
+    model_provider: Optional[str] = None
+    model_name: Optional[str] = None
+    enabled: Optional[bool] = None
+    cost_per_1k_input: Optional[float] = None
+    cost_per_1k_output: Optional[float] = None
+
+class AgentMetrics(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    
+    agent: str
+    model_provider: str
+    model_name: str
+    calls: int
+    failures: int
+    cancelled: int = 0
+    avg_latency_ms: float
+    max_latency_ms: float
+    est_input_tokens: int
+    est_output_tokens: int
+    est_cost: float
 
 class Settings(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -146,6 +391,50 @@ class TestResult(BaseModel):
     warnings: List[str] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class SearchMatch(BaseModel):
+    file_id: str
+    project_id: str
+    path: str
+    line: int
+    snippet: str
+
+class SearchResponse(BaseModel):
+    query: str
+    matches: List[SearchMatch]
+    truncated: bool = False
+    took_ms: float = 0
+
+class ActivityBucket(BaseModel):
+    date: str
+    events: int
+
+class DashboardStats(BaseModel):
+    projects_total: int = 0
+    projects_by_status: Dict[str, int] = {}
+    files_total: int = 0
+    test_runs: int = 0
+    tests_passed: int = 0
+    tests_failed: int = 0
+    activity: List[ActivityBucket] = []
+    generated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class Job(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    type: str
+    project_id: str
+    payload: Dict[str, Any] = {}
+    status: str = "queued"
+    attempts: int = 0
+    max_attempts: int = JOB_MAX_ATTEMPTS
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    available_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 # ==================== SOCKET.IO EVENTS ====================
 
 @sio.event
@@ -162,12 +451,140 @@ async def join_project(sid, data):
     await sio.enter_room(sid, f"project_{project_id}")
     print(f"Client {sid} joined project {project_id}")
 
-async def emit_to_project(project_id: str, event: str, data: dict):
-    """Отправить событие всем клиентам проекта"""
-    await sio.emit(event, data, room=f"project_{project_id}")
+async def emit_to_project(project_id: str, event: str, data: dict, local_only: bool = False):
+    """Отправить событие всем клиентам проекта (local_only - только клиентам этого процесса)"""
+    await sio.emit(event, data, room=f"project_{project_id}", ignore_queue=local_only)
+
+# ==================== PROJECT EVENTS ====================
+
+# Очереди подписчиков SSE по проектам
+project_subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+def subscribe_project(project_id: str) -> asyncio.Queue:
+    queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+    project_subscribers.setdefault(project_id, set()).add(queue)
+    return queue
+
+def unsubscribe_project(project_id: str, queue: asyncio.Queue):
+    subscribers = project_subscribers.get(project_id)
+    if subscribers is not None:
+        subscribers.discard(queue)
+        if not subscribers:
+            project_subscribers.pop(project_id, None)
+
+def is_subscribed(project_id: str, queue: asyncio.Queue) -> bool:
+    return queue in project_subscribers.get(project_id, ())
+
+def publish_project_event(project_id: str, event: str, data: dict, event_id: Optional[str] = None, key: Optional[str] = None):
+    """Передать событие подписчикам SSE; отставших подписчиков отключить.
+    event_id - курсор для Last-Event-ID (только у логов), key - id записи для отсева повторов"""
+    for queue in list(project_subscribers.get(project_id, ())):
+        try:
+            queue.put_nowait({"event": event, "id": event_id, "key": key, "data": data})
+        except asyncio.QueueFull:
+            # Клиент переподключится с Last-Event-ID и дочитает пропущенное из базы
+            unsubscribe_project(project_id, queue)
+
+def log_event_id(doc: dict) -> Optional[str]:
+    """Курсор SSE записи лога - ее порядковый номер (у старых записей его нет)"""
+    return str(doc['seq']) if doc.get('seq') is not None else None
+
+def log_event_payload(doc: dict) -> dict:
+    return {
+        'id': doc['id'],
+        'seq': doc.get('seq'),
+        'agent': doc['agent'],
+        'level': doc['level'],
+        'message': doc['message'],
+        'details': doc.get('details'),
+        'timestamp': doc['created_at']
+    }
+
+async def dispatch_log_event(doc: dict, local_only: bool = False):
+    """Разослать запись лога в Socket.IO и SSE"""
+    payload = log_event_payload(doc)
+    await emit_to_project(doc['project_id'], 'log', payload, local_only)
+    publish_project_event(doc['project_id'], 'log', payload, event_id=log_event_id(doc), key=doc['id'])
+
+async def dispatch_status_event(project_id: str, status: dict, timestamp: str, local_only: bool = False):
+    """Разослать статус проекта в Socket.IO и SSE"""
+    payload = {
+        'status': status.get('status'),
+        'progress': status.get('progress', 0),
+        'message': status.get('message', ""),
+        'current_step': status.get('current_step', ""),
+        'timestamp': timestamp
+    }
+    await emit_to_project(project_id, 'status', payload, local_only)
+    # Статус не хранится как история, поэтому не сдвигает курсор клиента
+    publish_project_event(project_id, 'status', payload)
+
+def relay_project_event(event: Optional[str], room: Optional[str], data: Any):
+    """Передать подписчикам SSE событие, пришедшее из очереди Socket.IO от другого процесса"""
+    if not isinstance(room, str) or not room.startswith('project_') or not isinstance(data, dict):
+        return
+    
+    project_id = room[len('project_'):]
+    if event == 'log':
+        publish_project_event(project_id, 'log', data, event_id=log_event_id(data), key=data.get('id'))
+    elif event == 'status':
+        publish_project_event(project_id, 'status', data)
+
+async def ensure_change_streams_supported():
+    """Change streams работают только в replica set или sharded cluster"""
+    hello = await client.admin.command("hello")
+    if not hello.get('setName') and hello.get('msg') != 'isdbgrid':
+        raise RuntimeError("EVENTS_FROM_CHANGE_STREAM=true требует replica set MongoDB; "
+                           "для событий между процессами достаточно SOCKETIO_MONGO_QUEUE")
+
+async def watch_project_events():
+    """Пересылать события, записанные другими процессами, из change streams MongoDB.
+    Change stream видит каждый API-процесс, поэтому Socket.IO рассылается только локально"""
+    async def watch_logs():
+        async with db.logs.watch([{"$match": {"operationType": "insert"}}]) as stream:
+            async for change in stream:
+                await dispatch_log_event(change['fullDocument'], local_only=True)
+    
+    async def watch_statuses():
+        pipeline = [{"$match": {"operationType": "update"}}]
+        async with db.projects.watch(pipeline, full_document='updateLookup') as stream:
+            async for change in stream:
+                updated = change['updateDescription']['updatedFields']
+                project = change.get('fullDocument')
+                if project and any(key.startswith('status') for key in updated):
+                    await dispatch_status_event(project['id'], project.get('status', {}), project.get('updated_at', ""), local_only=True)
+    
+    async def run_forever(watch):
+        while True:
+            try:
+                await watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Change stream прерван, переподключение")
+                await asyncio.sleep(1)
+    
+    await asyncio.gather(run_forever(watch_logs), run_forever(watch_statuses))
+
+def format_sse(event: str, data: dict, event_id: Optional[str] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return "\n".join(lines) + "\n\n"
 
 # ==================== HELPER FUNCTIONS ====================
 
+async def next_log_seq() -> int:
+    """Следующий номер записи лога. Общий счетчик в MongoDB дает уникальный и возрастающий
+    курсор во всех процессах, в отличие от created_at (часы процессов расходятся)"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": "logs"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['seq']
+
 async def create_log(project_id: str, agent: str, level: str, message: str, details: Optional[Dict] = None):
     """Создать лог запись и отправить через WebSocket"""
     log = LogEntry(
@@ -175,23 +592,21 @@ async def create_log(project_id: str, agent: str, level: str, message: str, deta
         agent=agent,
         level=level,
         message=message,
-        details=details
+        details=details,
+        seq=await next_log_seq()
     )
     doc = log.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.logs.insert_one(doc)
     
-    # Отправить через WebSocket
-    await emit_to_project(project_id, 'log', {
-        'agent': agent,
-        'level': level,
-        'message': message,
-        'details': details,
-        'timestamp': doc['created_at']
-    })
+    # Отправить через WebSocket и SSE (иначе событие придет из change stream)
+    if not EVENTS_FROM_CHANGE_STREAM:
+        await dispatch_log_event(doc)
 
 async def update_project_status(project_id: str, status: str, progress: int, message: str, current_step: str = ""):
     """Обновить статус проекта и отправить через WebSocket"""
+    updated_at = datetime.now(timezone.utc).isoformat()
+    
     await db.projects.update_one(
         {"id": project_id},
         {"$set": {
@@ -199,24 +614,31 @@ async def update_project_status(project_id: str, status: str, progress: int, mes
             "status.progress": progress,
             "status.message": message,
             "status.current_step": current_step,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+            "updated_at": updated_at
+        },
+        "$inc": {"version": 1}}
     )
     
-    # Отправить через WebSocket
-    await emit_to_project(project_id, 'status', {
-        'status': status,
-        'progress': progress,
-        'message': message,
-        'current_step': current_step
-    })
+    # Отправить через WebSocket и SSE (иначе событие придет из change stream)
+    if not EVENTS_FROM_CHANGE_STREAM:
+        await dispatch_status_event(project_id, {
+            'status': status,
+            'progress': progress,
+            'message': message,
+            'current_step': current_step
+        }, updated_at)
+
+async def ensure_project_exists(project_id: str):
+    """404, если проекта нет или он удален"""
+    if not await db.projects.count_documents({"id": project_id, **LIVE_PROJECT}, limit=1):
+        raise HTTPException(status_code=404, detail="Проект не найден")
 
 async def emit_file_created(project_id: str, file_data: dict):
     """Уведомить о создании файла"""
     await emit_to_project(project_id, 'file_created', file_data)
 
-async def get_llm_chat():
-    """Получить LLM chat клиент"""
+async def resolve_agent(agent: Optional[str] = None) -> Dict[str, Any]:
+    """Маршрут агента: модель и промпт из AgentConfig, иначе модель по умолчанию из настроек"""
     settings_doc = await db.settings.find_one({"id": "settings"})
     
     if settings_doc and not settings_doc.get('use_emergent_key', True) and settings_doc.get('llm_api_key'):
@@ -224,22 +646,477 @@ async def get_llm_chat():
     else:
         api_key = os.environ['EMERGENT_LLM_KEY']
     
-    model_name = settings_doc.get('default_model', 'gpt-4o') if settings_doc else 'gpt-4o'
+    route = {
+        "api_key": api_key,
+        "model_provider": "openai",
+        "model_name": settings_doc.get('default_model', 'gpt-4o') if settings_doc else 'gpt-4o',
+        "prompt_template": AGENT_PROMPTS.get(agent, ""),
+        "cost_per_1k_input": 0,
+        "cost_per_1k_output": 0
+    }
+    
+    if agent:
+        config = await db.agent_configs.find_one({"name": agent, "enabled": True}, {"_id": 0})
+        if config:
+            route.update(
+                model_provider=config['model_provider'],
+                model_name=config['model_name'],
+                prompt_template=config.get('prompt_template') or route['prompt_template'],
+                cost_per_1k_input=config.get('cost_per_1k_input', 0),
+                cost_per_1k_output=config.get('cost_per_1k_output', 0)
+            )
+    
+    return route
+
+async def get_llm_chat(agent: Optional[str] = None, route: Optional[Dict[str, Any]] = None):
+    """Получить LLM chat клиент для агента"""
+    # Интеграция с LLM тяжелая при импорте - загружаем при первом вызове агента
+    from emergentintegrations.llm.chat import LlmChat
+    
+    route = route or await resolve_agent(agent)
     
     chat = LlmChat(
-        api_key=api_key,
+        api_key=route['api_key'],
         session_id=str(uuid.uuid4()),
         system_message="Вы - AI агент, помогающий генерировать код и проекты."
     )
-    chat.with_model("openai", model_name)
+    chat.with_model(route['model_provider'], route['model_name'])
     
     return chat
 
+async def call_agent(agent: str, project_id: Optional[str] = None, **prompt_args) -> str:
+    """Вызвать агента через его модель и записать задержку и оценку стоимости вызова"""
+    from emergentintegrations.llm.chat import UserMessage
+    
+    route = await resolve_agent(agent)
+    prompt_text = route['prompt_template'].format(**prompt_args)
+    chat = await get_llm_chat(route=route)
+    
+    started = time.perf_counter()
+    response = ""
+    error = None
+    cancelled = False
+    
+    try:
+        response = await chat.send_message(UserMessage(text=prompt_text))
+        return response
+    except asyncio.CancelledError:
+        # Отмена (остановка генерации, потеря аренды) - не ошибка модели и не успех
+        cancelled = True
+        error = "cancelled"
+        raise
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        # Оценка токенов: ~4 символа на токен
+        input_tokens = len(prompt_text) // 4
+        output_tokens = len(response or "") // 4
+        
+        # Сбой записи метрик не должен подменять ответ модели или ее ошибку
+        try:
+            await db.agent_calls.insert_one({
+                "id": str(uuid.uuid4()),
+                "agent": agent,
+                "project_id": project_id,
+                "model_provider": route['model_provider'],
+                "model_name": route['model_name'],
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+                "est_input_tokens": input_tokens,
+                "est_output_tokens": output_tokens,
+                "est_cost": (input_tokens * route['cost_per_1k_input'] + output_tokens * route['cost_per_1k_output']) / 1000,
+                "success": error is None,
+                "cancelled": cancelled,
+                "error": error,
+                "created_at": datetime.now(timezone.utc).isoformat()
+            })
+        except Exception:
+            logger.exception(f"Не удалось записать метрики вызова агента {agent}")
+
+def make_etag(doc_id: str, version: int) -> str:
+    """Сильный ETag документа по его счетчику версий"""
+    return f'"{doc_id}-{version}"'
+
+def make_listing_etag(docs: List[dict], variant: str = "") -> str:
+    """ETag списка документов: хеш идентификаторов и версий в порядке выдачи"""
+    digest = hashlib.sha1(variant.encode('utf-8'))
+    for doc in docs:
+        digest.update(f"|{doc['id']}:{doc.get('version', 0)}".encode('utf-8'))
+    return f'"{digest.hexdigest()}"'
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Проверить заголовок If-None-Match на совпадение с ETag (слабое сравнение, W/ допустим)"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+def parse_etag_version(header: str, doc_id: str) -> Optional[int]:
+    """Извлечь версию документа из ETag вида "<id>-<version>" для If-Match.
+    If-Match требует сильного сравнения, поэтому слабый тег (W/...) не подходит"""
+    tag = header.strip()
+    if tag.startswith('W/'):
+        return None
+    tag = tag.strip('"')
+    prefix = f"{doc_id}-"
+    if not tag.startswith(prefix) or not tag[len(prefix):].isdigit():
+        return None
+    return int(tag[len(prefix):])
+
+def version_filter(version: int) -> Dict[str, Any]:
+    """Фильтр по версии документа (у старых документов поля version нет)"""
+    if version == 0:
+        return {"version": {"$exists": False}}
+    return {"version": version}
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+ASTRAL_CHAR = re.compile('[\U00010000-\U0010FFFF]')
+
+def utf16_index_map(content: str):
+    """Функция перевода смещения UTF-16 в индекс строки Python.
+    Для смещения вне текста или внутри суррогатной пары возвращает None"""
+    if not ASTRAL_CHAR.search(content):
+        # Только символы BMP: смещения совпадают с индексами
+        return lambda offset: offset if 0 <= offset <= len(content) else None
+    
+    indices: List[Optional[int]] = []
+    for index, char in enumerate(content):
+        indices.append(index)
+        if ord(char) > 0xFFFF:
+            indices.append(None)  # вторая половина суррогатной пары
+    indices.append(len(content))
+    
+    return lambda offset: indices[offset] if 0 <= offset < len(indices) else None
+
+def apply_text_edits(content: str, edits: List[TextEdit]) -> str:
+    """Применить правки по смещениям UTF-16 относительно исходного текста"""
+    to_index = utf16_index_map(content)
+    pieces = []
+    cursor = 0
+    
+    for edit in sorted(edits, key=lambda e: (e.start, e.end)):
+        start, end = to_index(edit.start), to_index(edit.end)
+        if start is None or end is None:
+            raise ValueError(f"Смещение правки вне текста или внутри суррогатной пары: {edit.start}-{edit.end}")
+        if start < cursor or end < start:
+            raise ValueError(f"Некорректный или пересекающийся диапазон правки: {edit.start}-{edit.end}")
+        pieces.append(content[cursor:start])
+        pieces.append(edit.text)
+        cursor = end
+    
+    pieces.append(content[cursor:])
+    return "".join(pieces)
+
+def apply_unified_diff(content: str, diff: str) -> str:
+    """Применить unified diff к тексту с проверкой контекстных строк и длины ханков"""
+    lines = content.splitlines(keepends=True)
+    diff_lines = diff.splitlines(keepends=True)
+    result = []
+    pos = 0
+    i = 0
+    seen_hunk = False
+    prev_tag = None
+    
+    while i < len(diff_lines):
+        line = diff_lines[i]
+        i += 1
+        header = HUNK_HEADER.match(line)
+        
+        if not header:
+            if line.startswith('\\'):
+                # "\ No newline at end of file" после последней строки ханка
+                if prev_tag == '+' and result:
+                    result[-1] = result[-1].rstrip('\r\n')
+            elif seen_hunk and line[:1] in (' ', '+', '-'):
+                raise ValueError(f"Ханк длиннее, чем указано в заголовке: {line.rstrip()}")
+            # заголовки ---/+++, пустые строки и прочий текст вне ханков пропускаем
+            prev_tag = None
+            continue
+        
+        old_start = int(header.group(1))
+        old_left = int(header.group(2)) if header.group(2) is not None else 1
+        new_left = int(header.group(4)) if header.group(4) is not None else 1
+        # При пустом старом диапазоне вставка идет после строки old_start
+        start = old_start if old_left == 0 else old_start - 1
+        
+        if start < pos or start > len(lines):
+            raise ValueError(f"Ханк вне файла или не по порядку: {header.group(0)}")
+        
+        result.extend(lines[pos:start])
+        pos = start
+        seen_hunk = True
+        prev_tag = None
+        
+        # Ровно столько строк, сколько объявлено в заголовке: обрезанный diff не применяем
+        while old_left or new_left:
+            if i >= len(diff_lines) or HUNK_HEADER.match(diff_lines[i]):
+                raise ValueError(f"Ханк обрывается раньше, чем указано в заголовке: {header.group(0)}")
+            
+            line = diff_lines[i]
+            i += 1
+            tag, body = (line[:1], line[1:]) if line.strip('\r\n') else (' ', line)
+            
+            if tag == '\\':
+                # "\ No newline at end of file" относится к предыдущей строке
+                if prev_tag == '+' and result:
+                    result[-1] = result[-1].rstrip('\r\n')
+                continue
+            
+            if tag in (' ', '-'):
+                if not old_left or (tag == ' ' and not new_left):
+                    raise ValueError(f"Ханк длиннее, чем указано в заголовке: {header.group(0)}")
+                if pos >= len(lines) or lines[pos].rstrip('\r\n') != body.rstrip('\r\n'):
+                    raise ValueError(f"Diff не совпадает с файлом в строке {pos + 1}")
+                if tag == ' ':
+                    result.append(lines[pos])
+                    new_left -= 1
+                old_left -= 1
+                pos += 1
+            elif tag == '+':
+                if not new_left:
+                    raise ValueError(f"Ханк длиннее, чем указано в заголовке: {header.group(0)}")
+                result.append(body)
+                new_left -= 1
+            else:
+                raise ValueError(f"Некорректная строка diff: {line.rstrip()}")
+            
+            prev_tag = tag
+    
+    result.extend(lines[pos:])
+    return "".join(result)
+
+def encode_file_content(content: str) -> Dict[str, Any]:
+    """Поля документа для хранения содержимого файла (большие файлы сжимаются zlib)"""
+    raw = content.encode('utf-8')
+    fields = {
+        "content": content,
+        "content_z": None,
+        "encoding": None,
+        "size": len(raw),
+        "compressed_size": None
+    }
+    
+    if len(raw) >= FILE_COMPRESSION_THRESHOLD:
+        packed = zlib.compress(raw, FILE_COMPRESSION_LEVEL)
+        if len(packed) < len(raw):
+            fields.update(content="", content_z=packed, encoding="zlib", compressed_size=len(packed))
+    
+    return fields
+
+def decode_file_doc(file: dict) -> dict:
+    """Распаковать содержимое файла в документе из базы (на месте)"""
+    packed = file.pop('content_z', None)
+    if packed is not None and file.pop('encoding', None) == 'zlib':
+        file['content'] = zlib.decompress(packed).decode('utf-8')
+    
+    if 'content' in file and 'size' not in file:
+        file['size'] = len(file['content'].encode('utf-8'))
+    
+    return file
+
+def extract_trigrams(text: str) -> set:
+    """Множество триграмм текста без учета регистра (без переходов строк)"""
+    lowered = text.lower()
+    return {gram for gram in (lowered[i:i + 3] for i in range(len(lowered) - 2)) if '\n' not in gram}
+
+async def index_file(file_id: str, project_id: str, path: str, content: str):
+    """Обновить запись файла в поисковом индексе"""
+    trigrams = extract_trigrams(content)
+    full_scan = len(trigrams) > SEARCH_MAX_TRIGRAMS
+    
+    await db.search_index.update_one(
+        {"file_id": file_id},
+        {"$set": {
+            "file_id": file_id,
+            "project_id": project_id,
+            "path": path,
+            "trigrams": [] if full_scan else sorted(trigrams),
+            "full_scan": full_scan
+        }},
+        upsert=True
+    )
+
+async def unindex_file(file_id: str):
+    """Удалить файл из поискового индекса"""
+    await db.search_index.delete_one({"file_id": file_id})
+
+async def search_files(query: str, project_id: Optional[str] = None, limit: int = 100) -> SearchResponse:
+    """Поиск подстроки по коду: кандидаты из триграммного индекса, затем проверка строк"""
+    started = time.perf_counter()
+    needle = query.lower()
+    
+    index_filter: Dict[str, Any] = {"$or": [
+        {"trigrams": {"$all": sorted(extract_trigrams(needle))}},
+        {"full_scan": True}
+    ]}
+    if project_id:
+        index_filter["project_id"] = project_id
+    
+    candidates = await db.search_index.find(index_filter, {"_id": 0, "file_id": 1}).to_list(None)
+    file_ids = [c['file_id'] for c in candidates]
+    deleted_projects = [] if project_id else await db.projects.distinct("id", {"deleted": True})
+    
+    matches = []
+    truncated = False
+    
+    if file_ids:
+        cursor = db.files.find(
+            {"id": {"$in": file_ids}, "project_id": {"$nin": deleted_projects}},
+            {"_id": 0, "id": 1, "project_id": 1, "path": 1, "content": 1, "content_z": 1, "encoding": 1}
+        ).sort("path", 1)
+        
+        async for file in cursor:
+            decode_file_doc(file)
+            for line_no, line in enumerate(file['content'].splitlines(), start=1):
+                if needle not in line.lower():
+                    continue
+                
+                if len(matches) >= limit:
+                    truncated = True
+                    break
+                
+                matches.append(SearchMatch(
+                    file_id=file['id'],
+                    project_id=file['project_id'],
+                    path=file['path'],
+                    line=line_no,
+                    snippet=line.strip()[:SEARCH_SNIPPET_LENGTH]
+                ))
+            
+            if truncated:
+                break
+    
+    return SearchResponse(
+        query=query,
+        matches=matches,
+        truncated=truncated,
+        took_ms=round((time.perf_counter() - started) * 1000, 2)
+    )
+
+# Слово "строка" перед номером: "line 12", "строка 12", "стр. 12"
+LINE_WORD = r'(?:\bline\b|\bстрок[аеиу]?\b|\bстр\.)'
+QUOTED_IDENTIFIER = re.compile(r'[`\'"]([A-Za-z_$][\w$]*)(?:\(\))?[`\'"]')
+
+def find_error_file(error: str, files: list) -> Optional[dict]:
+    """Найти файл, на который ссылается ошибка: полный путь важнее имени файла"""
+    by_path = [f for f in files if f['path'] in error]
+    if by_path:
+        return max(by_path, key=lambda f: len(f['path']))
+    
+    by_name = [
+        f for f in files
+        if re.search(rf"(?<![\w./-]){re.escape(Path(f['path']).name)}(?![\w-])", error)
+    ]
+    if len(by_name) == 1:
+        return by_name[0]
+    
+    return files[0] if len(files) == 1 else None
+
+def find_error_line(error: str, path: str) -> Optional[int]:
+    """Номер строки из текста ошибки. Учитываются только номера рядом с путем или именем файла:
+    "main.py:12", "main.py, line 12", "main.py (строка 12)", "line 12 in main.py".
+    Прочие числа (время, "10:30", коды ошибок) строкой не считаются"""
+    for name in dict.fromkeys((path, Path(path).name)):
+        file_ref = rf"(?<![\w.-]){re.escape(name)}(?![\w-])"
+        
+        after = re.search(rf"{file_ref}\W{{0,3}}(?:{LINE_WORD}\s*:?\s*)?(\d+)", error, re.IGNORECASE)
+        if after:
+            return int(after.group(1))
+        
+        before = re.search(rf"{LINE_WORD}\s*:?\s*(\d+),?\s+(?:in|в)\s+(?:файле\s+)?[`'\"]?{file_ref}", error, re.IGNORECASE)
+        if before:
+            return int(before.group(1))
+    
+    return None
+
+def find_symbol_definitions(names: List[str], files: list, skip: Optional[tuple] = None) -> List[str]:
+    """Определения символов (def/class/function/const) из файлов проекта"""
+    definitions = []
+    
+    for name in names:
+        pattern = re.compile(
+            rf'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:def|class|function|const|let|var|interface|type)\s+{re.escape(name)}\b'
+        )
+        
+        for file in files:
+            lines = file['content'].splitlines()
+            for idx, line in enumerate(lines):
+                if not pattern.match(line):
+                    continue
+                
+                # Определение уже попало в окно вокруг ошибки
+                if skip and file['path'] == skip[0] and skip[1] <= idx + 1 <= skip[2]:
+                    break
+                
+                snippet = "\n".join(lines[idx:idx + FIX_DEFINITION_LINES])
+                definitions.append(f"# {file['path']}:{idx + 1}\n{snippet}")
+                break
+            
+            if len(definitions) >= FIX_MAX_DEFINITIONS:
+                return definitions
+    
+    return definitions
+
+def build_fix_context(error: str, target_file: dict, files: list) -> Dict[str, Any]:
+    """Окно кода вокруг ошибки с номерами строк и связанные определения"""
+    lines = target_file['content'].splitlines()
+    total = len(lines)
+    names = list(dict.fromkeys(QUOTED_IDENTIFIER.findall(error)))
+    
+    if total <= FIX_WHOLE_FILE_LINES:
+        start, end = 1, total
+    else:
+        anchor = find_error_line(error, target_file['path'])
+        
+        if anchor is None:
+            # Без номера строки опираемся на первое упоминание символа из ошибки
+            anchor = next(
+                (idx + 1 for idx, line in enumerate(lines) if any(re.search(rf'\b{re.escape(n)}\b', line) for n in names)),
+                FIX_CONTEXT_LINES + 1
+            )
+        
+        anchor = min(max(anchor, 1), total)
+        start = max(anchor - FIX_CONTEXT_LINES, 1)
+        end = min(anchor + FIX_CONTEXT_LINES, total)
+    
+    code = "\n".join(f"{n:>5}| {lines[n - 1]}" for n in range(start, end + 1))
+    definitions = find_symbol_definitions(names, files, skip=(target_file['path'], start, end))
+    
+    return {
+        "start_line": start,
+        "end_line": end,
+        "total_lines": total,
+        "code": code,
+        "definitions": "\n\n".join(definitions) or "нет"
+    }
+
+def replace_lines(content: str, start_line: int, end_line: int, replacement: str) -> str:
+    """Заменить строки start_line..end_line (с 1, включительно); end_line = start_line - 1 - вставка"""
+    lines = content.splitlines(keepends=True)
+    
+    if not (1 <= start_line <= len(lines) + 1 and start_line - 1 <= end_line <= len(lines)):
+        raise ValueError(f"Некорректный диапазон строк: {start_line}-{end_line}")
+    
+    keeps_newline = end_line < len(lines) or (end_line >= 1 and lines[end_line - 1].endswith('\n'))
+    if replacement and keeps_newline and not replacement.endswith('\n'):
+        replacement += '\n'
+    
+    head = "".join(lines[:start_line - 1])
+    if replacement and head and not head.endswith('\n'):
+        # Вставка после последней строки без перевода строки
+        head += '\n'
+    
+    return head + replacement + "".join(lines[end_line:])
+
 # ==================== AGENTS PROMPTS ====================
 
 AGENT_PROMPTS = {
-    "generator": """
-Вы - агент генерации проекта. Ваша задача - создать структуру проекта на основе описания пользователя.
+    "planner": """
+Вы - агент планирования проекта. Ваша задача - спланировать структуру проекта на основе описания пользователя.
 
 Промпт пользователя: {prompt}
 
@@ -247,18 +1124,35 @@ AGENT_PROMPTS = {
 1. Проанализировать требования
 2. Создать список необходимых файлов
 3. Определить технологии и библиотеки
-4. Сгенерировать базовую структуру проекта
+4. Описать интерфейсы каждого файла, чтобы файлы можно было сгенерировать независимо
 
-Верните JSON с следующей структурой:
+Не генерируйте содержимое файлов. Верните JSON с следующей структурой:
 {{
   "project_name": "название проекта",
   "description": "описание проекта",
   "files": [
-    {{"path": "путь/к/файлу", "content": "содержимое", "language": "язык"}}
+    {{"path": "путь/к/файлу", "language": "язык", "purpose": "назначение файла", "interfaces": "экспортируемые функции, классы и их сигнатуры; что файл импортирует из других файлов"}}
   ],
   "technologies": ["список технологий"],
   "next_steps": ["следующие шаги"]
 }}
+""",
+    "generator": """
+Вы - агент генерации кода. Ваша задача - написать один файл проекта согласно общему плану.
+
+Промпт пользователя: {prompt}
+
+План проекта:
+{manifest}
+
+Файл для генерации:
+Путь: {path}
+Язык: {language}
+Назначение: {purpose}
+Интерфейсы: {interfaces}
+
+Соблюдайте интерфейсы из плана, чтобы файл согласовывался с остальными файлами проекта.
+Верните только содержимое файла, без пояснений и без markdown-разметки.
 """,
     "tester": """
 Вы - агент тестирования. Ваша задача - проверить проект на ошибки.
@@ -276,7 +1170,7 @@ AGENT_PROMPTS = {
 {{
   "tests_passed": количество,
   "tests_failed": количество,
-  "errors": ["список ошибок с указанием файла и строки"],
+  "errors": ["путь/к/файлу:строка: описание ошибки"],
   "warnings": ["предупреждения"],
   "suggestions": ["рекомендации"]
 }}
@@ -288,29 +1182,88 @@ AGENT_PROMPTS = {
 Путь: {file_path}
 Ошибка: {error}
 
-Текущий код:
+Фрагмент кода (строки {start_line}-{end_line} из {total_lines}, слева номера строк):
 {code}
 
+Связанные определения из проекта:
+{definitions}
+
 Ваши задачи:
 1. Проанализировать ошибку
-2. Исправить код
+2. Исправить код минимальной правкой внутри показанного фрагмента
 3. Убедиться что исправление не ломает другой функционал
 
 Верните JSON:
 {{
-  "fixed_code": "исправленный код",
+  "start_line": номер первой заменяемой строки,
+  "end_line": номер последней заменяемой строки (start_line - 1 для вставки),
+  "replacement": "новый текст вместо этих строк, без номеров строк",
   "explanation": "объяснение что было исправлено",
   "additional_fixes": ["другие найденные и исправленные проблемы"]
 }}
 """
 }
 
+def validate_prompt_template(agent: str, template: str):
+    """Проверить, что шаблон форматируется аргументами, которые передает агенту call_agent"""
+    if not template:
+        return
+    
+    # Аргументы агента - поля его встроенного шаблона
+    keys = {field for _, field, _, _ in string.Formatter().parse(AGENT_PROMPTS[agent]) if field}
+    
+    try:
+        template.format(**{key: "" for key in keys})
+    except (KeyError, IndexError, ValueError, AttributeError) as e:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Некорректный шаблон промпта: {e!r}. Доступные поля: {', '.join(sorted(keys))}; "
+                   "фигурные скобки в тексте нужно удваивать"
+        )
+
 # ==================== ROUTES ====================
 
 @api_router.get("/")
 async def root():
     return {"message": "Emergent Clone API v2.0", "status": "running"}
 
+# ========== HEALTH ==========
+
+@api_router.get("/healthz")
+async def healthz():
+    """Проверка живости процесса (без обращения к базе)"""
+    return {"status": "ok", "uptime_seconds": round(time.monotonic() - app.state.started_at, 1)}
+
+@api_router.get("/readyz")
+async def readyz(response: Response):
+    """Готовность принимать трафик: прогрев завершен и MongoDB отвечает"""
+    pool = {
+        **pool_monitor.snapshot(),
+        "max_size": client.delegate.options.pool_options.max_pool_size,
+        "min_size": client.delegate.options.pool_options.min_pool_size
+    }
+    
+    if getattr(app.state, 'startup_error', None):
+        response.status_code = 503
+        return {"status": "failed", "error": app.state.startup_error, "pool": pool}
+    
+    if not getattr(app.state, 'ready', False):
+        response.status_code = 503
+        return {"status": "starting", "pool": pool}
+    
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=READINESS_TIMEOUT)
+    except Exception as e:
+        response.status_code = 503
+        return {"status": "unavailable", "error": str(e), "pool": pool}
+    
+    return {
+        "status": "ready",
+        "db_latency_ms": round((time.perf_counter() - started) * 1000, 2),
+        "pool": pool
+    }
+
 # ========== PROJECTS ==========
 
 @api_router.post("/projects", response_model=Project)
@@ -339,14 +1292,22 @@ async def create_project(input: ProjectCreate):
     await create_log(project.id, "system", "info", "Проект создан", {"prompt": input.prompt})
     
     # Запустить генерацию в фоне
-    asyncio.create_task(generate_project_with_details(project.id, input.prompt))
+    await enqueue_job("generate", project.id, {"prompt": input.prompt})
     
     return project
 
 @api_router.get("/projects", response_model=List[Project])
-async def get_projects():
+async def get_projects(response: Response, if_none_match: Optional[str] = Header(None)):
     """Получить все проекты"""
-    projects = await db.projects.find({}, {"_id": 0}).to_list(1000)
+    versions = await db.projects.find(LIVE_PROJECT, {"_id": 0, "id": 1, "version": 1}).to_list(1000)
+    etag = make_listing_etag(versions)
+    
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    projects = await db.projects.find(LIVE_PROJECT, {"_id": 0}).to_list(1000)
+    # ETag по фактически отданным документам: между запросами список мог измениться
+    response.headers["ETag"] = make_listing_etag(projects)
     
     for project in projects:
         if isinstance(project['created_at'], str):
@@ -360,13 +1321,19 @@ async def get_projects():
     return projects
 
 @api_router.get("/projects/{project_id}", response_model=Project)
-async def get_project(project_id: str):
+async def get_project(project_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
     """Получить проект по ID"""
-    project = await db.projects.find_one({"id": project_id}, {"_id": 0})
+    project = await db.projects.find_one({"id": project_id, **LIVE_PROJECT}, {"_id": 0})
     
     if not project:
         raise HTTPException(status_code=404, detail="Проект не найден")
     
+    etag = make_etag(project_id, project.get('version', 0))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    response.headers["ETag"] = etag
+    
     if isinstance(project['created_at'], str):
         project['created_at'] = datetime.fromisoformat(project['created_at'])
     if isinstance(project['updated_at'], str):
@@ -379,22 +1346,25 @@ async def get_project(project_id: str):
 
 @api_router.delete("/projects/{project_id}")
 async def delete_project(project_id: str):
-    """Удалить проект"""
-    result = await db.projects.delete_one({"id": project_id})
+    """Удалить проект: пометить надгробием, данные удалит фоновая задача"""
+    now = datetime.now(timezone.utc).isoformat()
     
-    if result.deleted_count == 0:
+    result = await db.projects.update_one(
+        {"id": project_id, **LIVE_PROJECT},
+        {"$set": {"deleted": True, "deleted_at": now, "updated_at": now}, "$inc": {"version": 1}}
+    )
+    
+    if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Проект не найден")
     
-    await db.files.delete_many({"project_id": project_id})
-    await db.logs.delete_many({"project_id": project_id})
-    await db.versions.delete_many({"project_id": project_id})
+    await enqueue_job("reap", project_id)
     
     return {"message": "Проект удален"}
 
 @api_router.post("/projects/{project_id}/regenerate")
 async def regenerate_project(project_id: str):
     """Перегенерировать проект"""
-    project = await db.projects.find_one({"id": project_id}, {"_id": 0})
+    project = await db.projects.find_one({"id": project_id, **LIVE_PROJECT}, {"_id": 0})
     
     if not project:
         raise HTTPException(status_code=404, detail="Проект не найден")
@@ -402,18 +1372,31 @@ async def regenerate_project(project_id: str):
     await update_project_status(project_id, "creating", 5, "Перегенерация...", "Инициализация")
     await create_log(project_id, "system", "info", "Начата перегенерация проекта")
     
-    asyncio.create_task(generate_project_with_details(project_id, project['prompt']))
+    await enqueue_job("generate", project_id, {"prompt": project['prompt']})
     
     return {"message": "Перегенерация запущена"}
 
 # ========== FILES ==========
 
 @api_router.get("/projects/{project_id}/files", response_model=List[FileItem])
-async def get_project_files(project_id: str):
-    """Получить все файлы проекта"""
-    files = await db.files.find({"project_id": project_id}, {"_id": 0}).to_list(1000)
+async def get_project_files(project_id: str, response: Response, include_content: bool = True, if_none_match: Optional[str] = Header(None)):
+    """Получить все файлы проекта (без содержимого при include_content=false)"""
+    await ensure_project_exists(project_id)
+    
+    versions = await db.files.find({"project_id": project_id}, {"_id": 0, "id": 1, "version": 1}).to_list(1000)
+    etag = make_listing_etag(versions, variant="content" if include_content else "meta")
+    
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    projection = {"_id": 0} if include_content else {"_id": 0, "content": 0, "content_z": 0}
+    files = await db.files.find({"project_id": project_id}, projection).to_list(1000)
+    # ETag по фактически отданным документам: между запросами список мог измениться
+    response.headers["ETag"] = make_listing_etag(files, variant="content" if include_content else "meta")
     
     for file in files:
+        decode_file_doc(file)
+        file.setdefault('content', "")
         if isinstance(file['created_at'], str):
             file['created_at'] = datetime.fromisoformat(file['created_at'])
         if isinstance(file['updated_at'], str):
@@ -424,6 +1407,8 @@ async def get_project_files(project_id: str):
 @api_router.post("/projects/{project_id}/files", response_model=FileItem)
 async def create_file(project_id: str, input: FileCreate):
     """Создать файл"""
+    await ensure_project_exists(project_id)
+    
     file = FileItem(
         project_id=project_id,
         path=input.path,
@@ -431,26 +1416,47 @@ async def create_file(project_id: str, input: FileCreate):
         language=input.language
     )
     
+    stored = encode_file_content(file.content)
+    file.size = stored['size']
+    file.compressed_size = stored['compressed_size']
+    
     doc = file.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
+    doc.update(stored)
     
     await db.files.insert_one(doc)
     await db.projects.update_one(
         {"id": project_id},
-        {"$inc": {"files_count": 1}}
+        {"$inc": {"files_count": 1, "version": 1}}
     )
+    await index_file(file.id, project_id, file.path, file.content)
     
     return file
 
 @api_router.get("/files/{file_id}", response_model=FileItem)
-async def get_file(file_id: str):
+async def get_file(file_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
     """Получить файл по ID"""
-    file = await db.files.find_one({"id": file_id}, {"_id": 0})
+    # Сначала только метаданные: при совпадении ETag содержимое не читаем
+    file = await db.files.find_one({"id": file_id}, {"_id": 0, "content": 0, "content_z": 0})
     
     if not file:
         raise HTTPException(status_code=404, detail="Файл не найден")
     
+    await ensure_project_exists(file['project_id'])
+    
+    etag = make_etag(file_id, file.get('version', 0))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    # Содержимое и ETag берем из одного документа: файл мог измениться после первого запроса
+    file = await db.files.find_one({"id": file_id}, {"_id": 0})
+    if not file:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    decode_file_doc(file)
+    response.headers["ETag"] = make_etag(file_id, file.get('version', 0))
+    
     if isinstance(file['created_at'], str):
         file['created_at'] = datetime.fromisoformat(file['created_at'])
     if isinstance(file['updated_at'], str):
@@ -459,52 +1465,176 @@ async def get_file(file_id: str):
     return file
 
 @api_router.put("/files/{file_id}", response_model=FileItem)
-async def update_file(file_id: str, input: FileUpdate):
-    """Обновить файл"""
-    file = await db.files.find_one({"id": file_id}, {"_id": 0})
+async def update_file(file_id: str, input: FileUpdate, response: Response, if_match: Optional[str] = Header(None)):
+    """Обновить файл (If-Match - оптимистичная блокировка по ETag)"""
+    owner = await db.files.find_one({"id": file_id}, {"_id": 0, "project_id": 1})
     
-    if not file:
+    if not owner:
         raise HTTPException(status_code=404, detail="Файл не найден")
     
-    await db.files.update_one(
-        {"id": file_id},
+    await ensure_project_exists(owner['project_id'])
+    
+    file_filter: Dict[str, Any] = {"id": file_id}
+    
+    if if_match and if_match.strip() != '*':
+        expected = parse_etag_version(if_match, file_id)
+        if expected is None:
+            raise HTTPException(status_code=412, detail="Файл был изменен")
+        file_filter.update(version_filter(expected))
+    
+    stored = encode_file_content(input.content)
+    
+    file = await db.files.find_one_and_update(
+        file_filter,
         {"$set": {
-            "content": input.content,
+            **stored,
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        },
+        "$inc": {"version": 1}},
+        projection={"_id": 0, "content": 0, "content_z": 0},
+        return_document=ReturnDocument.AFTER
     )
     
+    if not file:
+        if if_match and await db.files.count_documents({"id": file_id}, limit=1):
+            raise HTTPException(status_code=412, detail="Файл был изменен")
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    response.headers["ETag"] = make_etag(file_id, file['version'])
+    
+    await index_file(file_id, file['project_id'], file['path'], input.content)
+    
+    decode_file_doc(file)
     file['content'] = input.content
-    file['updated_at'] = datetime.now(timezone.utc)
     
     if isinstance(file['created_at'], str):
         file['created_at'] = datetime.fromisoformat(file['created_at'])
+    if isinstance(file['updated_at'], str):
+        file['updated_at'] = datetime.fromisoformat(file['updated_at'])
     
     return FileItem(**file)
 
+@api_router.patch("/files/{file_id}", response_model=FilePatchResult)
+async def patch_file(file_id: str, input: FilePatch, response: Response):
+    """Частично обновить файл: правки по диапазонам или unified diff относительно base_version"""
+    if (input.edits is None) == (input.diff is None):
+        raise HTTPException(status_code=400, detail="Нужно передать либо edits, либо diff")
+    
+    file = await db.files.find_one({"id": file_id}, {"_id": 0})
+    
+    if not file:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    await ensure_project_exists(file['project_id'])
+    
+    if file.get('version', 0) != input.base_version:
+        raise HTTPException(status_code=409, detail="Базовая версия файла устарела")
+    
+    decode_file_doc(file)
+    
+    try:
+        if input.edits is not None:
+            new_content = apply_text_edits(file['content'], input.edits)
+        else:
+            new_content = apply_unified_diff(file['content'], input.diff)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    stored = encode_file_content(new_content)
+    
+    updated = await db.files.find_one_and_update(
+        {"id": file_id, **version_filter(input.base_version)},
+        {"$set": {
+            **stored,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        },
+        "$inc": {"version": 1}},
+        projection={"_id": 0, "version": 1, "updated_at": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if not updated:
+        raise HTTPException(status_code=409, detail="Базовая версия файла устарела")
+    
+    await index_file(file_id, file['project_id'], file['path'], new_content)
+    
+    # В комнату проекта уходит только дельта
+    delta = {'edits': [e.model_dump() for e in input.edits]} if input.edits is not None else {'diff': input.diff}
+    await emit_to_project(file['project_id'], 'file_patched', {
+        'id': file_id,
+        'path': file['path'],
+        'base_version': input.base_version,
+        'version': updated['version'],
+        **delta
+    })
+    
+    response.headers["ETag"] = make_etag(file_id, updated['version'])
+    
+    return FilePatchResult(
+        id=file_id,
+        path=file['path'],
+        version=updated['version'],
+        size=stored['size'],
+        compressed_size=stored['compressed_size'],
+        updated_at=datetime.fromisoformat(updated['updated_at'])
+    )
+
 @api_router.delete("/files/{file_id}")
 async def delete_file(file_id: str):
     """Удалить файл"""
-    file = await db.files.find_one({"id": file_id}, {"_id": 0})
+    file = await db.files.find_one({"id": file_id}, {"_id": 0, "project_id": 1})
     
     if not file:
         raise HTTPException(status_code=404, detail="Файл не найден")
     
+    await ensure_project_exists(file['project_id'])
+    
     result = await db.files.delete_one({"id": file_id})
     
     if result.deleted_count > 0:
         await db.projects.update_one(
             {"id": file['project_id']},
-            {"$inc": {"files_count": -1}}
+            {"$inc": {"files_count": -1, "version": 1}}
         )
+        await unindex_file(file_id)
     
     return {"message": "Файл удален"}
 
+# ========== SEARCH ==========
+
+@api_router.get("/projects/{project_id}/search", response_model=SearchResponse)
+async def search_project(project_id: str, q: str = Query(..., min_length=3), limit: int = Query(100, ge=1, le=1000)):
+    """Поиск по коду проекта"""
+    await ensure_project_exists(project_id)
+    return await search_files(q, project_id=project_id, limit=limit)
+
+@api_router.get("/search", response_model=SearchResponse)
+async def search_all_projects(q: str = Query(..., min_length=3), limit: int = Query(100, ge=1, le=1000)):
+    """Поиск по коду всех проектов"""
+    return await search_files(q, limit=limit)
+
+@api_router.post("/projects/{project_id}/search/reindex")
+async def reindex_project(project_id: str):
+    """Перестроить поисковый индекс проекта"""
+    await ensure_project_exists(project_id)
+    
+    await db.search_index.delete_many({"project_id": project_id})
+    
+    indexed = 0
+    async for file in db.files.find({"project_id": project_id}, {"_id": 0, "id": 1, "path": 1, "content": 1, "content_z": 1, "encoding": 1}):
+        decode_file_doc(file)
+        await index_file(file['id'], project_id, file['path'], file['content'])
+        indexed += 1
+    
+    return {"message": "Индекс перестроен", "files_indexed": indexed}
+
 # ========== VERSIONS ==========
 
 @api_router.get("/projects/{project_id}/versions", response_model=List[Version])
 async def get_versions(project_id: str):
     """Получить историю версий"""
+    await ensure_project_exists(project_id)
+    
     versions = await db.versions.find({"project_id": project_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     
     for version in versions:
@@ -516,6 +1646,8 @@ async def get_versions(project_id: str):
 @api_router.post("/projects/{project_id}/versions", response_model=Version)
 async def create_version(project_id: str, input: VersionCreate):
     """Создать версию (коммит)"""
+    await ensure_project_exists(project_id)
+    
     version = Version(
         project_id=project_id,
         message=input.message,
@@ -535,6 +1667,8 @@ async def create_version(project_id: str, input: VersionCreate):
 @api_router.get("/projects/{project_id}/logs", response_model=List[LogEntry])
 async def get_logs(project_id: str, limit: int = 100):
     """Получить логи проекта"""
+    await ensure_project_exists(project_id)
+    
     logs = await db.logs.find({"project_id": project_id}, {"_id": 0}).sort("created_at", -1).to_list(limit)
     
     for log in logs:
@@ -543,6 +1677,149 @@ async def get_logs(project_id: str, limit: int = 100):
     
     return logs
 
+@api_router.get("/projects/{project_id}/logs/stream")
+async def stream_logs(
+    project_id: str,
+    request: Request,
+    since: Optional[str] = None,
+    tail: int = Query(100, ge=0, le=1000),
+    last_event_id: Optional[str] = Header(None)
+):
+    """Поток логов и статуса проекта (Server-Sent Events).
+    Продолжение по Last-Event-ID (номер записи) или since (время created_at)"""
+    project = await db.projects.find_one({"id": project_id, **LIVE_PROJECT}, {"_id": 0, "status": 1})
+    
+    if not project:
+        raise HTTPException(status_code=404, detail="Проект не найден")
+    
+    # Last-Event-ID - номер записи; прежние клиенты могли сохранить время записи
+    cursor = last_event_id or since
+    if cursor and cursor.strip().isdigit():
+        history_filter = {"project_id": project_id, "seq": {"$gt": int(cursor)}}
+        history_order = "seq"
+    else:
+        history_filter = {"project_id": project_id, "created_at": {"$gt": cursor}}
+        history_order = "created_at"
+    
+    async def event_stream():
+        # Подписаться до чтения истории, чтобы не потерять события между ними
+        queue = subscribe_project(project_id)
+        
+        try:
+            # Текущий статус без id, чтобы не сдвигать курсор клиента
+            yield format_sse('status', {**project.get('status', {})})
+            
+            # id отданных из истории записей: те же записи могли попасть и в очередь
+            replayed = set()
+            
+            if cursor:
+                # Вся история после курсора, курсор MongoDB отдает ее пачками
+                history = db.logs.find(history_filter, {"_id": 0}).sort(history_order, 1)
+                async for doc in history:
+                    replayed.add(doc['id'])
+                    yield format_sse('log', log_event_payload(doc), log_event_id(doc))
+            elif tail:
+                history = await db.logs.find(
+                    {"project_id": project_id}, {"_id": 0}
+                ).sort("created_at", -1).to_list(tail)
+                for doc in reversed(history):
+                    replayed.add(doc['id'])
+                    yield format_sse('log', log_event_payload(doc), log_event_id(doc))
+            
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if not is_subscribed(project_id, queue):
+                        break
+                    yield ": ping\n\n"
+                    continue
+                
+                # Уже отдано из истории. Порядок живых событий по времени не гарантирован,
+                # поэтому отсеиваем только повторы истории, а не все события старше курсора
+                if item['key'] is not None and item['key'] in replayed:
+                    continue
+                
+                yield format_sse(item['event'], item['data'], item['id'])
+        finally:
+            unsubscribe_project(project_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ========== STATS ==========
+
+# Кеш по числу дней гистограммы: days -> (истекает, статистика)
+_stats_cache: Dict[int, tuple] = {}
+
+async def compute_dashboard_stats(days: int) -> DashboardStats:
+    """Посчитать статистику дашборда агрегациями на стороне MongoDB"""
+    today = datetime.now(timezone.utc).date()
+    first_day = today - timedelta(days=days - 1)
+    
+    deleted_projects = await db.projects.distinct("id", {"deleted": True})
+    
+    projects_pipeline = [
+        {"$match": LIVE_PROJECT},
+        {"$facet": {
+            "by_status": [{"$group": {"_id": "$status.status", "count": {"$sum": 1}}}],
+            "totals": [{"$group": {"_id": None, "projects": {"$sum": 1}, "files": {"$sum": "$files_count"}}}]
+        }}
+    ]
+    tests_pipeline = [
+        {"$match": {"project_id": {"$nin": deleted_projects}}},
+        {"$group": {
+            "_id": None,
+            "runs": {"$sum": 1},
+            "passed": {"$sum": "$tests_passed"},
+            "failed": {"$sum": "$tests_failed"}
+        }}
+    ]
+    # created_at хранится в ISO-формате, первые 10 символов - дата
+    activity_pipeline = [
+        {"$match": {"created_at": {"$gte": first_day.isoformat()}, "project_id": {"$nin": deleted_projects}}},
+        {"$group": {"_id": {"$substrBytes": ["$created_at", 0, 10]}, "events": {"$sum": 1}}}
+    ]
+    
+    projects_rows, tests_rows, activity_rows = await asyncio.gather(
+        db.projects.aggregate(projects_pipeline).to_list(1),
+        db.test_results.aggregate(tests_pipeline).to_list(1),
+        db.logs.aggregate(activity_pipeline).to_list(None)
+    )
+    
+    facets = projects_rows[0] if projects_rows else {"by_status": [], "totals": []}
+    totals = facets['totals'][0] if facets['totals'] else {}
+    tests = tests_rows[0] if tests_rows else {}
+    events_by_day = {row['_id']: row['events'] for row in activity_rows}
+    
+    return DashboardStats(
+        projects_total=totals.get('projects', 0),
+        projects_by_status={row['_id'] or "unknown": row['count'] for row in facets['by_status']},
+        files_total=totals.get('files', 0),
+        test_runs=tests.get('runs', 0),
+        tests_passed=tests.get('passed', 0),
+        tests_failed=tests.get('failed', 0),
+        activity=[
+            ActivityBucket(date=day.isoformat(), events=events_by_day.get(day.isoformat(), 0))
+            for day in (first_day + timedelta(days=n) for n in range(days))
+        ]
+    )
+
+@api_router.get("/stats", response_model=DashboardStats)
+async def get_stats(days: int = Query(14, ge=1, le=90)):
+    """Статистика для дашборда (кешируется на STATS_CACHE_TTL секунд)"""
+    cached = _stats_cache.get(days)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    stats = await compute_dashboard_stats(days)
+    _stats_cache[days] = (time.monotonic() + STATS_CACHE_TTL, stats)
+    
+    return stats
+
 # ========== SETTINGS ==========
 
 @api_router.get("/settings", response_model=Settings)
@@ -576,15 +1853,121 @@ async def update_settings(input: SettingsUpdate):
     
     return await get_settings()
 
+# ========== AGENTS ==========
+
+def _parse_agent_config(config: dict) -> AgentConfig:
+    for key in ('created_at', 'updated_at'):
+        if isinstance(config.get(key), str):
+            config[key] = datetime.fromisoformat(config[key])
+    return AgentConfig(**config)
+
+@api_router.get("/agents", response_model=List[AgentConfig])
+async def get_agent_configs():
+    """Получить настройки агентов"""
+    configs = await db.agent_configs.find({}, {"_id": 0}).sort("name", 1).to_list(100)
+    return [_parse_agent_config(config) for config in configs]
+
+@api_router.post("/agents", response_model=AgentConfig)
+async def create_agent_config(input: AgentConfigCreate):
+    """Создать настройки агента"""
+    if input.name not in AGENT_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный агент. Доступны: {', '.join(AGENT_PROMPTS)}")
+    
+    validate_prompt_template(input.name, input.prompt_template)
+    
+    if await db.agent_configs.count_documents({"name": input.name}, limit=1):
+        raise HTTPException(status_code=409, detail="Настройки агента уже существуют")
+    
+    config = AgentConfig(**input.model_dump())
+    
+    doc = config.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    doc['updated_at'] = doc['updated_at'].isoformat()
+    
+    await db.agent_configs.insert_one(doc)
+    
+    return config
+
+@api_router.get("/agents/metrics", response_model=List[AgentMetrics])
+async def get_agent_metrics(hours: int = Query(24, ge=1, le=24 * 90)):
+    """Задержка и оценка стоимости вызовов по агентам и моделям"""
+    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+    
+    pipeline = [
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": {"agent": "$agent", "model_provider": "$model_provider", "model_name": "$model_name"},
+            "calls": {"$sum": 1},
+            "failures": {"$sum": {"$cond": [{"$or": ["$success", "$cancelled"]}, 0, 1]}},
+            "cancelled": {"$sum": {"$cond": ["$cancelled", 1, 0]}},
+            "avg_latency_ms": {"$avg": "$latency_ms"},
+            "max_latency_ms": {"$max": "$latency_ms"},
+            "est_input_tokens": {"$sum": "$est_input_tokens"},
+            "est_output_tokens": {"$sum": "$est_output_tokens"},
+            "est_cost": {"$sum": "$est_cost"}
+        }},
+        {"$sort": {"_id.agent": 1, "calls": -1}}
+    ]
+    
+    rows = await db.agent_calls.aggregate(pipeline).to_list(None)
+    
+    return [
+        AgentMetrics(**row['_id'], **{k: v for k, v in row.items() if k != '_id'})
+        for row in rows
+    ]
+
+@api_router.get("/agents/{name}", response_model=AgentConfig)
+async def get_agent_config(name: str):
+    """Получить настройки агента"""
+    config = await db.agent_configs.find_one({"name": name}, {"_id": 0})
+    
+    if not config:
+        raise HTTPException(status_code=404, detail="Настройки агента не найдены")
+    
+    return _parse_agent_config(config)
+
+@api_router.put("/agents/{name}", response_model=AgentConfig)
+async def update_agent_config(name: str, input: AgentConfigUpdate):
+    """Обновить настройки агента"""
+    update_data = {k: v for k, v in input.model_dump().items() if v is not None}
+    
+    if 'prompt_template' in update_data and name in AGENT_PROMPTS:
+        validate_prompt_template(name, update_data['prompt_template'])
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    
+    config = await db.agent_configs.find_one_and_update(
+        {"name": name},
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if not config:
+        raise HTTPException(status_code=404, detail="Настройки агента не найдены")
+    
+    return _parse_agent_config(config)
+
+@api_router.delete("/agents/{name}")
+async def delete_agent_config(name: str):
+    """Удалить настройки агента (агент вернется к модели по умолчанию)"""
+    result = await db.agent_configs.delete_one({"name": name})
+    
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Настройки агента не найдены")
+    
+    return {"message": "Настройки агента удалены"}
+
 # ========== TESTING ==========
 
 @api_router.post("/projects/{project_id}/test")
 async def test_project(project_id: str):
     """Запустить тестирование проекта"""
+    await ensure_project_exists(project_id)
+    
     await update_project_status(project_id, "testing", 50, "Запуск тестов...", "Тестирование")
     await create_log(project_id, "tester", "info", "Начато тестирование")
     
-    asyncio.create_task(run_project_tests_with_fixes(project_id))
+    await enqueue_job("test", project_id)
     
     return {"message": "Тестирование запущено"}
 
@@ -593,6 +1976,8 @@ async def test_project(project_id: str):
 @api_router.post("/projects/{project_id}/deploy")
 async def deploy_project(project_id: str, repo_name: str):
     """Деплой проекта в GitHub"""
+    await ensure_project_exists(project_id)
+    
     settings = await db.settings.find_one({"id": "settings"}, {"_id": 0})
     
     if not settings or not settings.get('github_token'):
@@ -601,37 +1986,91 @@ async def deploy_project(project_id: str, repo_name: str):
     await update_project_status(project_id, "deploying", 80, "Деплой в GitHub...", "Деплой")
     await create_log(project_id, "deploy", "info", "Начат деплой в GitHub")
     
-    asyncio.create_task(deploy_to_github(project_id, repo_name, settings['github_token']))
+    # Токен не кладем в задачу: воркер прочитает его из настроек
+    await enqueue_job("deploy", project_id, {"repo_name": repo_name})
     
     return {"message": "Деплой запущен"}
 
+# ========== JOBS ==========
+
+@api_router.get("/projects/{project_id}/jobs", response_model=List[Job])
+async def get_project_jobs(project_id: str, limit: int = 50):
+    """Получить фоновые задачи проекта"""
+    await ensure_project_exists(project_id)
+    
+    jobs = await db.jobs.find({"project_id": project_id}, {"_id": 0}).sort("created_at", -1).to_list(limit)
+    
+    for job in jobs:
+        for key in ('created_at', 'updated_at', 'available_at', 'lease_expires_at'):
+            if isinstance(job.get(key), str):
+                job[key] = datetime.fromisoformat(job[key])
+    
+    return jobs
+
 # ==================== BACKGROUND TASKS ====================
 
+def strip_code_fence(text: str) -> str:
+    """Убрать обрамляющий markdown-блок кода из ответа модели"""
+    stripped = text.strip()
+    if stripped.startswith("```") and stripped.endswith("```") and stripped.count("\n") >= 1:
+        stripped = stripped.split("\n", 1)[1].rsplit("```", 1)[0]
+    return stripped.rstrip() + "\n"
+
+def format_manifest(files: List[dict]) -> str:
+    """Краткое описание плана файлов для промпта генерации"""
+    return "\n".join(
+        f"- {f.get('path', 'unknown.txt')} ({f.get('language', 'text')}): {f.get('purpose', '')}; интерфейсы: {f.get('interfaces', '')}"
+        for f in files
+    )
+
+async def save_generated_file(project_id: str, path: str, content: str, language: str) -> FileItem:
+    """Сохранить сгенерированный файл, проиндексировать и уведомить клиентов"""
+    file = FileItem(
+        project_id=project_id,
+        path=path,
+        content=content,
+        language=language
+    )
+    
+    stored = encode_file_content(file.content)
+    file.size = stored['size']
+    file.compressed_size = stored['compressed_size']
+    
+    doc = file.model_dump()
+    doc['created_at'] = doc['created_at'].isoformat()
+    doc['updated_at'] = doc['updated_at'].isoformat()
+    doc.update(stored)
+    
+    await db.files.insert_one(doc)
+    await index_file(file.id, project_id, file.path, file.content)
+    
+    # Уведомить о создании файла
+    await emit_file_created(project_id, {
+        'id': file.id,
+        'path': file.path,
+        'language': file.language,
+        'size': file.size,
+        'version': file.version
+    })
+    
+    return file
+
 async def generate_project_with_details(project_id: str, prompt: str):
-    """Генерация проекта с детальным отображением процесса"""
+    """Генерация проекта: планирование, затем параллельная генерация файлов"""
     try:
         # Шаг 1: Анализ промпта
         await update_project_status(project_id, "creating", 10, "Анализ требований...", "Анализ промпта")
         await create_log(project_id, "generator", "info", "Начат анализ промпта")
-        await asyncio.sleep(1)
         
         # Шаг 2: Подключение к AI
         await update_project_status(project_id, "creating", 20, "Подключение к AI...", "Инициализация LLM")
         await create_log(project_id, "generator", "info", "Подключение к AI модели")
         
-        chat = await get_llm_chat()
-        
-        # Шаг 3: Генерация структуры
-        await update_project_status(project_id, "creating", 30, "Генерация структуры проекта...", "Планирование")
+        # Шаг 3: Планирование структуры (только манифест файлов, без содержимого)
+        await update_project_status(project_id, "creating", 30, "Планирование структуры проекта...", "Планирование")
         await create_log(project_id, "generator", "info", "AI анализирует требования и планирует структуру")
         
-        agent_prompt = AGENT_PROMPTS["generator"].format(prompt=prompt)
-        message = UserMessage(text=agent_prompt)
-        
-        await update_project_status(project_id, "creating", 40, "AI генерирует файлы...", "Генерация кода")
-        await create_log(project_id, "generator", "info", "Запущена генерация кода")
-        
-        response = await chat.send_message(message)
+        response = await call_agent("planner", project_id, prompt=prompt)
         
         # Парсинг ответа
         try:
@@ -661,66 +2100,93 @@ async def generate_project_with_details(project_id: str, prompt: str):
             {"$set": {
                 "name": result.get("project_name", f"project_{uuid.uuid4().hex[:8]}"),
                 "description": result.get("description", prompt)
-            }}
+            },
+            "$inc": {"version": 1}}
         )
         
-        await update_project_status(project_id, "creating", 50, "Создание файлов...", "Сохранение файлов")
-        await create_log(project_id, "generator", "info", f"Создание {len(result.get('files', []))} файлов")
+        # Убрать дубликаты путей из плана
+        planned = list({f.get("path", "unknown.txt"): f for f in result.get("files", [])}.values())
+        total_files = len(planned)
+        manifest = format_manifest(planned)
         
-        # Создать файлы с уведомлениями
-        files_created = 0
-        total_files = len(result.get("files", []))
+        await update_project_status(project_id, "creating", 40, "AI генерирует файлы...", "Генерация кода")
+        await create_log(project_id, "generator", "info", f"План готов: {total_files} файлов, параллельная генерация по {GENERATION_CONCURRENCY}")
         
-        for idx, file_data in enumerate(result.get("files", [])):
-            file = FileItem(
-                project_id=project_id,
-                path=file_data.get("path", "unknown.txt"),
-                content=file_data.get("content", ""),
-                language=file_data.get("language", "text")
-            )
-            
-            doc = file.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            doc['updated_at'] = doc['updated_at'].isoformat()
-            
-            await db.files.insert_one(doc)
-            files_created += 1
-            
-            # Уведомить о создании файла
-            await emit_file_created(project_id, {
-                'id': file.id,
-                'path': file.path,
-                'language': file.language,
-                'size': len(file.content)
-            })
-            
-            progress = 50 + int((idx + 1) / total_files * 30)
-            await update_project_status(
-                project_id, 
-                "creating", 
-                progress, 
-                f"Создан файл {idx + 1}/{total_files}: {file.path}",
-                f"Файл {idx + 1}/{total_files}"
-            )
-            await create_log(project_id, "generator", "info", f"✓ Создан файл: {file.path}")
+        semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+        
+        async def generate_file(spec: dict):
+            # Содержимое уже есть (базовая структура) - модель не нужна
+            if spec.get("content") is not None:
+                return spec, spec["content"], None
             
-            await asyncio.sleep(0.5)  # Небольшая задержка для визуализации
+            async with semaphore:
+                try:
+                    content = await call_agent(
+                        "generator",
+                        project_id,
+                        prompt=prompt,
+                        manifest=manifest,
+                        path=spec.get("path", "unknown.txt"),
+                        language=spec.get("language", "text"),
+                        purpose=spec.get("purpose", ""),
+                        interfaces=spec.get("interfaces", "")
+                    )
+                    return spec, strip_code_fence(content), None
+                except Exception as e:
+                    return spec, None, e
+        
+        # Создать файлы по мере готовности
+        files_created = 0
+        files_done = 0
+        tasks = [asyncio.create_task(generate_file(spec)) for spec in planned]
+        
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                spec, content, error = await next_done
+                files_done += 1
+                path = spec.get("path", "unknown.txt")
+                
+                if error is not None:
+                    await create_log(project_id, "generator", "error", f"✗ Не удалось сгенерировать файл {path}: {str(error)}")
+                    continue
+                
+                file = await save_generated_file(project_id, path, content, spec.get("language", "text"))
+                files_created += 1
+                
+                progress = 40 + int(files_done / total_files * 50)
+                await update_project_status(
+                    project_id, 
+                    "creating", 
+                    progress, 
+                    f"Создан файл {files_done}/{total_files}: {file.path}",
+                    f"Файл {files_done}/{total_files}"
+                )
+                await create_log(project_id, "generator", "info", f"✓ Создан файл: {file.path}")
+        finally:
+            # При ошибке сохранения или отмене (потеря аренды) не оставлять генерацию в фоне
+            for task in tasks:
+                task.cancel()
         
         # Обновить счетчик файлов
         await db.projects.update_one(
             {"id": project_id},
-            {"$set": {"files_count": files_created}}
+            {"$set": {"files_count": files_created}, "$inc": {"version": 1}}
         )
         
+        if total_files and files_created == 0:
+            raise RuntimeError("Не удалось сгенерировать ни одного файла")
+        
         await update_project_status(project_id, "ready", 100, "Проект готов", "Завершено")
         await create_log(project_id, "generator", "info", f"✓ Проект создан: {files_created} файлов", {
             "files_count": files_created,
+            "files_failed": total_files - files_created,
             "technologies": result.get("technologies", [])
         })
         
     except Exception as e:
-        await update_project_status(project_id, "failed", 0, f"Ошибка: {str(e)}", "Ошибка")
+        # Повтор с задержкой или окончательный провал (статус failed) решает очередь задач
         await create_log(project_id, "generator", "error", f"Ошибка генерации: {str(e)}")
+        raise
 
 async def run_project_tests_with_fixes(project_id: str):
     """Запуск тестов с автоматическим исправлением ошибок"""
@@ -735,7 +2201,7 @@ async def run_project_tests_with_fixes(project_id: str):
             await create_log(project_id, "tester", "info", f"Запуск тестирования (попытка {iteration}/{max_iterations})")
             
             # Получить файлы проекта
-            files = await db.files.find({"project_id": project_id}, {"_id": 0}).to_list(1000)
+            files = [decode_file_doc(f) for f in await db.files.find({"project_id": project_id}, {"_id": 0}).to_list(1000)]
             
             if not files:
                 await update_project_status(project_id, "ready", 100, "Нет файлов для тестирования", "Завершено")
@@ -743,20 +2209,13 @@ async def run_project_tests_with_fixes(project_id: str):
             
             await create_log(project_id, "tester", "info", f"Анализ {len(files)} файлов")
             
-            # Получить LLM клиент
-            chat = await get_llm_chat()
-            
             # Подготовить данные о файлах
             files_info = "\n\n".join([f"Файл: {f['path']}\nЯзык: {f['language']}\nСодержимое:\n{f['content'][:1000]}...\n" for f in files[:5]])
             
-            # Сформировать промпт для тестирования
-            agent_prompt = AGENT_PROMPTS["tester"].format(files=files_info)
-            message = UserMessage(text=agent_prompt)
-            
             await update_project_status(project_id, "testing", 60 + iteration * 10, "AI проверяет код на ошибки...", "Проверка")
             
             # Получить результаты тестирования
-            response = await chat.send_message(message)
+            response = await call_agent("tester", project_id, files=files_info)
             
             # Парсинг результатов
             try:
@@ -813,9 +2272,9 @@ async def run_project_tests_with_fixes(project_id: str):
                 break
             
         except Exception as e:
-            await update_project_status(project_id, "ready", 100, f"Ошибка тестирования: {str(e)}", "Ошибка")
+            # Повтор с задержкой или окончательный провал решает очередь задач
             await create_log(project_id, "tester", "error", f"Ошибка: {str(e)}")
-            break
+            raise
 
 async def fix_errors(project_id: str, files: list, errors: list) -> int:
     """Автоматическое исправление ошибок"""
@@ -825,29 +2284,24 @@ async def fix_errors(project_id: str, files: list, errors: list) -> int:
         try:
             await create_log(project_id, "fixer", "info", f"Исправление: {error}")
             
-            # Найти файл с ошибкой (простой поиск по имени файла в тексте ошибки)
-            target_file = None
-            for file in files:
-                if file['path'] in error:
-                    target_file = file
-                    break
+            # Найти файл с ошибкой по пути или имени файла в тексте ошибки
+            target_file = find_error_file(error, files)
             
             if not target_file:
-                target_file = files[0]  # Если не нашли, берем первый файл
+                await create_log(project_id, "fixer", "warning", f"Не удалось определить файл для ошибки: {error}")
+                continue
             
-            # Получить LLM клиент
-            chat = await get_llm_chat()
+            # Сформировать промпт только с окном кода вокруг ошибки
+            context = build_fix_context(error, target_file, files)
             
-            # Сформировать промпт для исправления
-            agent_prompt = AGENT_PROMPTS["fixer"].format(
+            # Получить исправление
+            response = await call_agent(
+                "fixer",
+                project_id,
                 file_path=target_file['path'],
                 error=error,
-                code=target_file['content']
+                **context
             )
-            message = UserMessage(text=agent_prompt)
-            
-            # Получить исправленный код
-            response = await chat.send_message(message)
             
             # Парсинг ответа
             try:
@@ -858,18 +2312,45 @@ async def fix_errors(project_id: str, files: list, errors: list) -> int:
                     response_text = response_text.split("```")[1].split("```")[0]
                 
                 fix_result = json.loads(response_text)
-                fixed_code = fix_result.get("fixed_code", "")
+                fixed_code = ""
+                
+                if "start_line" in fix_result and "end_line" in fix_result:
+                    start_line = int(fix_result["start_line"])
+                    end_line = int(fix_result["end_line"])
+                    
+                    if not (context["start_line"] <= start_line <= context["end_line"] + 1 and start_line - 1 <= end_line <= context["end_line"]):
+                        raise ValueError(f"Правка вне показанного фрагмента: строки {start_line}-{end_line}")
+                    
+                    fixed_code = replace_lines(target_file['content'], start_line, end_line, fix_result.get("replacement", ""))
+                elif fix_result.get("fixed_code") and context["start_line"] == 1 and context["end_line"] == context["total_lines"]:
+                    # Полный код принимаем, только если модель видела файл целиком
+                    fixed_code = fix_result["fixed_code"]
                 
-                if fixed_code:
-                    # Обновить файл
-                    await db.files.update_one(
-                        {"id": target_file['id']},
+                if fixed_code and fixed_code != target_file['content']:
+                    # Обновить файл, только если его не изменили, пока модель думала
+                    updated = await db.files.find_one_and_update(
+                        {"id": target_file['id'], **version_filter(target_file.get('version', 0))},
                         {"$set": {
-                            "content": fixed_code,
+                            **encode_file_content(fixed_code),
                             "updated_at": datetime.now(timezone.utc).isoformat()
-                        }}
+                        },
+                        "$inc": {"version": 1}},
+                        projection={"_id": 0, "version": 1},
+                        return_document=ReturnDocument.AFTER
                     )
                     
+                    if not updated:
+                        # Правка посчитана по устаревшему тексту: не затираем изменения пользователя
+                        current = await db.files.find_one({"id": target_file['id']}, {"_id": 0})
+                        if current:
+                            target_file.update(decode_file_doc(current))
+                        await create_log(project_id, "fixer", "warning", f"Файл {target_file['path']} изменен во время исправления, исправление пропущено")
+                        continue
+                    
+                    await index_file(target_file['id'], project_id, target_file['path'], fixed_code)
+                    target_file['content'] = fixed_code
+                    target_file['version'] = updated['version']
+                    
                     fixed_count += 1
                     await create_log(project_id, "fixer", "info", f"✓ Исправлен файл: {target_file['path']}", {
                         "explanation": fix_result.get("explanation", "")
@@ -880,6 +2361,7 @@ async def fix_errors(project_id: str, files: list, errors: list) -> int:
                         'id': target_file['id'],
                         'path': target_file['path'],
                         'language': target_file['language'],
+                        'version': updated['version'],
                         'updated': True
                     })
                     
@@ -901,7 +2383,7 @@ async def deploy_to_github(project_id: str, repo_name: str, github_token: str):
         
         await db.projects.update_one(
             {"id": project_id},
-            {"$set": {"github_url": github_url}}
+            {"$set": {"github_url": github_url}, "$inc": {"version": 1}}
         )
         
         await update_project_status(project_id, "deployed", 100, "Деплой завершен", "Завершено")
@@ -911,6 +2393,359 @@ async def deploy_to_github(project_id: str, repo_name: str, github_token: str):
         await update_project_status(project_id, "ready", 100, f"Ошибка деплоя: {str(e)}", "Ошибка")
         await create_log(project_id, "deploy", "error", f"Ошибка деплоя: {str(e)}")
 
+# ==================== JOB QUEUE ====================
+#
+# Задачи хранятся в коллекции jobs, поэтому переживают перезапуск процесса
+# и могут выполняться любым количеством воркеров. Воркер атомарно забирает
+# задачу через find_one_and_update и держит аренду (lease), продлевая ее
+# heartbeat'ом. Задачи с истекшей арендой возвращаются в очередь.
+# Обработчики пробрасывают ошибки: задача повторяется с экспоненциальной задержкой
+# до JOB_MAX_ATTEMPTS попыток, затем проект получает статус из JOB_FAILURE_STATUS.
+
+# Статус проекта, если задача окончательно провалилась
+JOB_FAILURE_STATUS = {
+    "generate": "failed",
+    "test": "ready",
+    "deploy": "ready",
+}
+
+async def enqueue_job(job_type: str, project_id: str, payload: Optional[Dict] = None, delay: float = 0) -> Job:
+    """Поставить задачу в очередь (delay - через сколько секунд ее можно забрать)"""
+    job = Job(type=job_type, project_id=project_id, payload=payload or {})
+    job.available_at += timedelta(seconds=delay)
+    
+    doc = job.model_dump()
+    doc['available_at'] = doc['available_at'].isoformat()
+    doc['created_at'] = doc['created_at'].isoformat()
+    doc['updated_at'] = doc['updated_at'].isoformat()
+    
+    await db.jobs.insert_one(doc)
+    return job
+
+async def claim_job(worker_id: str) -> Optional[dict]:
+    """Атомарно забрать следующую задачу из очереди и взять ее в аренду"""
+    now = datetime.now(timezone.utc)
+    
+    return await db.jobs.find_one_and_update(
+        {"status": "queued", "available_at": {"$lte": now.isoformat()}},
+        {
+            "$set": {
+                "status": "running",
+                "lease_owner": worker_id,
+                "lease_expires_at": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat(),
+                "updated_at": now.isoformat()
+            },
+            "$inc": {"attempts": 1}
+        },
+        projection={"_id": 0},
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def heartbeat_job(job_id: str, worker_id: str) -> bool:
+    """Продлить аренду задачи. Возвращает False, если аренда потеряна"""
+    now = datetime.now(timezone.utc)
+    
+    result = await db.jobs.update_one(
+        {"id": job_id, "status": "running", "lease_owner": worker_id},
+        {"$set": {
+            "lease_expires_at": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat(),
+            "updated_at": now.isoformat()
+        }}
+    )
+    return result.matched_count > 0
+
+async def complete_job(job_id: str, worker_id: str):
+    """Отметить задачу выполненной"""
+    await db.jobs.update_one(
+        {"id": job_id, "lease_owner": worker_id},
+        {"$set": {
+            "status": "done",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+
+async def _mark_job_failed(job: dict, error: str, owner_filter: Dict[str, Any]):
+    """Окончательно провалить задачу и снять проект с зависшего статуса"""
+    result = await db.jobs.update_one(
+        {"id": job['id'], **owner_filter},
+        {"$set": {
+            "status": "failed",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "last_error": error,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    
+    # У служебных задач (например, reap) нет статуса проекта, который нужно снимать
+    if result.modified_count > 0 and job['type'] in JOB_FAILURE_STATUS:
+        status = JOB_FAILURE_STATUS[job['type']]
+        progress = 0 if status == "failed" else 100
+        await update_project_status(job['project_id'], status, progress, f"Ошибка: {error}", "Ошибка")
+        await create_log(job['project_id'], "system", "error", f"Задача {job['type']} провалена: {error}")
+
+async def fail_job(job: dict, worker_id: str, error: str):
+    """Вернуть задачу в очередь с задержкой или провалить, если попытки исчерпаны"""
+    if job['attempts'] >= job['max_attempts']:
+        await _mark_job_failed(job, error, {"lease_owner": worker_id})
+        return
+    
+    now = datetime.now(timezone.utc)
+    backoff = min(5 * 2 ** (job['attempts'] - 1), 300)
+    
+    result = await db.jobs.update_one(
+        {"id": job['id'], "lease_owner": worker_id},
+        {"$set": {
+            "status": "queued",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "last_error": error,
+            "available_at": (now + timedelta(seconds=backoff)).isoformat(),
+            "updated_at": now.isoformat()
+        }}
+    )
+    
+    if result.modified_count > 0 and job['type'] in JOB_FAILURE_STATUS:
+        await create_log(
+            job['project_id'], "system", "warning",
+            f"Задача {job['type']} будет повторена через {backoff} с (попытка {job['attempts']}/{job['max_attempts']}): {error}"
+        )
+
+async def requeue_expired_jobs() -> int:
+    """Вернуть в очередь задачи с истекшей арендой"""
+    now_iso = datetime.now(timezone.utc).isoformat()
+    expired = {"status": "running", "lease_expires_at": {"$lt": now_iso}}
+    
+    # Задачи без оставшихся попыток проваливаем
+    exhausted = await db.jobs.find(
+        {**expired, "$expr": {"$gte": ["$attempts", "$max_attempts"]}},
+        {"_id": 0}
+    ).to_list(100)
+    
+    for job in exhausted:
+        await _mark_job_failed(job, "Истек срок аренды задачи", {"status": "running", "lease_owner": job['lease_owner']})
+    
+    result = await db.jobs.update_many(
+        expired,
+        {"$set": {
+            "status": "queued",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "available_at": now_iso,
+            "updated_at": now_iso
+        }}
+    )
+    
+    if result.modified_count:
+        logger.warning(f"Возвращено в очередь задач с истекшей арендой: {result.modified_count}")
+    
+    return result.modified_count
+
+async def _run_generate_job(job: dict):
+    if job['attempts'] > 1:
+        # Повторная попытка: убрать файлы, оставшиеся от прерванного запуска
+        await db.files.delete_many({"project_id": job['project_id']})
+        await db.search_index.delete_many({"project_id": job['project_id']})
+        await db.projects.update_one(
+            {"id": job['project_id']},
+            {"$set": {"files_count": 0}, "$inc": {"version": 1}}
+        )
+    
+    await generate_project_with_details(job['project_id'], job['payload']['prompt'])
+
+async def _run_test_job(job: dict):
+    await run_project_tests_with_fixes(job['project_id'])
+
+async def _run_deploy_job(job: dict):
+    settings = await db.settings.find_one({"id": "settings"}, {"_id": 0})
+    
+    if not settings or not settings.get('github_token'):
+        raise RuntimeError("GitHub токен не настроен")
+    
+    await deploy_to_github(job['project_id'], job['payload']['repo_name'], settings['github_token'])
+
+async def _run_reap_job(job: dict):
+    """Удалить данные проекта-надгробия пачками, не мешая рабочей нагрузке"""
+    project_id = job['project_id']
+    
+    for name in REAP_COLLECTIONS:
+        collection = db[name]
+        batch_filter: Dict[str, Any] = {"project_id": project_id}
+        if name == "jobs":
+            # Выполняющиеся задачи (включая эту) не трогаем
+            batch_filter["status"] = {"$ne": "running"}
+        
+        while True:
+            batch = await collection.find(batch_filter, {"_id": 1}).limit(REAP_BATCH_SIZE).to_list(REAP_BATCH_SIZE)
+            if not batch:
+                break
+            
+            await collection.delete_many({"_id": {"$in": [doc['_id'] for doc in batch]}})
+            await asyncio.sleep(REAP_BATCH_DELAY)
+    
+    # Пока по проекту выполняются другие задачи, они могут дописать данные - повторить позже
+    if await db.jobs.count_documents({"project_id": project_id, "status": "running", "id": {"$ne": job['id']}}, limit=1):
+        await enqueue_job("reap", project_id, delay=JOB_LEASE_SECONDS)
+        return
+    
+    await db.projects.delete_one({"id": project_id, "deleted": True})
+    logger.info(f"Удаленный проект {project_id} вычищен")
+
+JOB_HANDLERS = {
+    "generate": _run_generate_job,
+    "test": _run_test_job,
+    "deploy": _run_deploy_job,
+    "reap": _run_reap_job,
+}
+
+async def _job_heartbeat_loop(job: dict, worker_id: str, handler_task: asyncio.Task) -> Optional[str]:
+    """Продлевать аренду, пока выполняется обработчик. Обработчик отменяется и возвращается причина:
+    "lease" - аренда потеряна (задача уже может выполняться другим воркером),
+    "deleted" - проект удален. None - обработчик завершился сам"""
+    job_id = job['id']
+    interval = JOB_LEASE_SECONDS / 3
+    renewed_at = time.monotonic()
+    
+    while not handler_task.done():
+        await asyncio.sleep(interval)
+        
+        try:
+            # Не тратить вызовы модели на проект, удаленный во время выполнения
+            if job['type'] != "reap" and not await db.projects.count_documents({"id": job['project_id'], **LIVE_PROJECT}, limit=1):
+                logger.info(f"Проект {job['project_id']} удален, задача {job_id} прерывается")
+                handler_task.cancel()
+                return "deleted"
+            
+            if await heartbeat_job(job_id, worker_id):
+                renewed_at = time.monotonic()
+                continue
+            logger.warning(f"Аренда задачи {job_id} потеряна воркером {worker_id}")
+        except Exception:
+            logger.exception(f"Не удалось продлить аренду задачи {job_id}")
+            # Ошибку базы можно переждать, пока аренда не истечет до следующей попытки
+            if time.monotonic() - renewed_at + interval < JOB_LEASE_SECONDS:
+                continue
+            logger.warning(f"Аренда задачи {job_id} истекает, выполнение прерывается")
+        
+        handler_task.cancel()
+        return "lease"
+    
+    return None
+
+async def process_job(job: dict, worker_id: str):
+    """Выполнить задачу, удерживая аренду до завершения"""
+    try:
+        handler = JOB_HANDLERS.get(job['type'])
+        if handler is None:
+            raise RuntimeError(f"Неизвестный тип задачи: {job['type']}")
+        
+        # Задачи удаленных проектов не выполняем
+        if job['type'] != "reap" and not await db.projects.count_documents({"id": job['project_id'], **LIVE_PROJECT}, limit=1):
+            await complete_job(job['id'], worker_id)
+            return
+    except Exception as e:
+        logger.exception(f"Задача {job['id']} ({job['type']}) не может быть запущена")
+        await fail_job(job, worker_id, str(e))
+        return
+    
+    handler_task = asyncio.create_task(handler(job))
+    heartbeat = asyncio.create_task(_job_heartbeat_loop(job, worker_id, handler_task))
+    
+    try:
+        await handler_task
+    except asyncio.CancelledError:
+        # Отмена самого воркера (остановка) - пробрасываем; аренда истечет, задача вернется в очередь
+        reason = heartbeat.result() if heartbeat.done() else None
+        if reason is None:
+            raise
+        if reason == "deleted":
+            # Задача удаленного проекта выполнена не будет; reap дочистит то, что она успела записать
+            await complete_job(job['id'], worker_id)
+        else:
+            logger.warning(f"Задача {job['id']} ({job['type']}) прервана: аренда потеряна")
+    except Exception as e:
+        logger.exception(f"Задача {job['id']} ({job['type']}) завершилась с ошибкой")
+        await fail_job(job, worker_id, str(e))
+    else:
+        await complete_job(job['id'], worker_id)
+    finally:
+        heartbeat.cancel()
+
+async def run_job_worker(worker_id: Optional[str] = None, concurrency: int = JOB_WORKER_CONCURRENCY, stop_event: Optional[asyncio.Event] = None):
+    """Цикл воркера: забирает задачи из очереди и выполняет их до остановки"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stop_event = stop_event or asyncio.Event()
+    
+    async def wait_or_stop(timeout: float):
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def sweeper():
+        while not stop_event.is_set():
+            try:
+                await requeue_expired_jobs()
+            except Exception:
+                logger.exception("Ошибка при возврате задач с истекшей арендой")
+            await wait_or_stop(JOB_LEASE_SECONDS / 2)
+    
+    async def slot():
+        while not stop_event.is_set():
+            try:
+                job = await claim_job(worker_id)
+            except Exception:
+                logger.exception("Ошибка при получении задачи из очереди")
+                job = None
+            
+            if job is None:
+                await wait_or_stop(JOB_POLL_INTERVAL)
+                continue
+            
+            await process_job(job, worker_id)
+    
+    logger.info(f"Воркер {worker_id} запущен, параллельность: {concurrency}")
+    await asyncio.gather(sweeper(), *(slot() for _ in range(concurrency)))
+    logger.info(f"Воркер {worker_id} остановлен")
+
+async def warm_up_database() -> float:
+    """Открыть минимальный пул соединений и проверить MongoDB; возвращает задержку ping в мс"""
+    started = time.perf_counter()
+    connections = max(client.delegate.options.pool_options.min_pool_size, 1)
+    
+    # Параллельные ping занимают разные соединения и открывают пул до minPoolSize
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+    
+    return round((time.perf_counter() - started) * 1000, 2)
+
+async def ensure_indexes():
+    """Создать индексы очереди задач, поиска, агентов, логов и проектов"""
+    await ensure_socketio_queue()
+    
+    await db.jobs.create_index("id", unique=True)
+    await db.jobs.create_index([("status", 1), ("available_at", 1)])
+    await db.jobs.create_index([("status", 1), ("lease_expires_at", 1)])
+    await db.jobs.create_index([("project_id", 1), ("created_at", -1)])
+    
+    await db.search_index.create_index("file_id", unique=True)
+    await db.search_index.create_index([("project_id", 1), ("trigrams", 1)])
+    await db.search_index.create_index("trigrams")
+    await db.search_index.create_index([("full_scan", 1), ("project_id", 1)])
+    
+    await db.agent_configs.create_index("name", unique=True)
+    await db.agent_calls.create_index("created_at")
+    
+    await db.logs.create_index([("project_id", 1), ("created_at", -1)])
+    await db.logs.create_index([("project_id", 1), ("seq", 1)])
+    await db.logs.create_index("created_at")
+    
+    await db.projects.create_index("deleted", sparse=True)
+    for name in ("files", "versions", "test_results"):
+        await db[name].create_index("project_id")
+
 # ==================== STARTUP ====================
 
 # Include router
@@ -922,6 +2757,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 # Mount Socket.IO
@@ -934,8 +2770,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def start_background_services():
+    """Прогреть пул, создать индексы и запустить фоновые задачи; затем отметить готовность"""
+    # Повторяем всю подготовку базы: индексы тоже могут упасть при недоступной MongoDB
+    while True:
+        try:
+            latency = await warm_up_database()
+            logger.info(f"Пул MongoDB прогрет, ping {latency} мс")
+            await ensure_indexes()
+            break
+        except Exception:
+            logger.exception(f"Не удалось подготовить MongoDB при старте, повтор через {STARTUP_RETRY_DELAY} с")
+            await asyncio.sleep(STARTUP_RETRY_DELAY)
+    
+    if EVENTS_FROM_CHANGE_STREAM:
+        # Без replica set события не дойдут ни до SSE, ни до Socket.IO - не объявляем готовность
+        await ensure_change_streams_supported()
+        app.state.events_watcher = asyncio.create_task(watch_project_events())
+    
+    # Встроенный воркер для развертывания в один процесс;
+    # при выделенных воркерах (worker.py) его отключают через RUN_EMBEDDED_WORKER=false
+    if RUN_EMBEDDED_WORKER:
+        app.state.job_worker_stop = asyncio.Event()
+        app.state.job_worker = asyncio.create_task(run_job_worker(stop_event=app.state.job_worker_stop))
+    
+    app.state.ready = True
+
+def log_startup_failure(task: asyncio.Task):
+    """Не дать ошибке фонового старта пропасть молча: иначе /api/readyz просто не станет готов"""
+    if not task.cancelled() and task.exception() is not None:
+        app.state.startup_error = str(task.exception())
+        logger.error("Фоновый старт сервисов завершился ошибкой", exc_info=task.exception())
+
+@app.on_event("startup")
+async def startup_services():
+    # Процесс жив сразу, готов - после прогрева (см. /api/readyz)
+    app.state.started_at = time.monotonic()
+    app.state.ready = False
+    app.state.startup_error = None
+    app.state.startup = asyncio.create_task(start_background_services())
+    app.state.startup.add_done_callback(log_startup_failure)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.ready = False
+    app.state.startup.cancel()
+    if EVENTS_FROM_CHANGE_STREAM and hasattr(app.state, 'events_watcher'):
+        app.state.events_watcher.cancel()
+    if RUN_EMBEDDED_WORKER and hasattr(app.state, 'job_worker'):
+        app.state.job_worker_stop.set()
+        app.state.job_worker.cancel()
     client.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+"""Воркер очереди фоновых задач.
+
+Запускается отдельно от API (из каталога backend):
+
+    python worker.py
+
+Забирает из коллекции jobs задачи генерации, тестирования и деплоя.
+Воркеров можно запускать на любом количестве машин с тем же MONGO_URL/DB_NAME.
+
+События Socket.IO (статус, логи, файлы) воркер всегда публикует в capped-коллекцию
+socketio_events, откуда их раздает клиентам Socket.IO и SSE API-процесс. API слушает
+эту очередь при RUN_EMBEDDED_WORKER=false (или явно SOCKETIO_MONGO_QUEUE=true).
+"""
+import asyncio
+import os
+import signal
+
+# Клиентов в процессе воркера нет: события должны уйти в общую очередь,
+# независимо от настроек, рассчитанных на API-процесс
+os.environ['SOCKETIO_MONGO_QUEUE'] = 'true'
+
+from server import client, ensure_indexes, logger, run_job_worker, warm_up_database
+
+
+async def main():
+    latency = await warm_up_database()
+    logger.info(f"Пул MongoDB прогрет, ping {latency} мс")
+    await ensure_indexes()
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    try:
+        await run_job_worker(stop_event=stop_event)
+    finally:
+        logger.info("Закрытие подключения к MongoDB")
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,14 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py читает настройки при импорте; подключение к MongoDB ленивое
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+for module in ('fastapi', 'motor', 'socketio'):
+    pytest.importorskip(module)
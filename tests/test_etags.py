@@ -0,0 +1,63 @@
+import pytest
+
+from server import etag_matches, make_etag, make_listing_etag, parse_etag_version, version_filter
+
+
+# ========== etag_matches (If-None-Match) ==========
+
+def test_strong_tag_matches():
+    assert etag_matches('"f-3"', make_etag("f", 3))
+
+
+def test_weak_tag_matches_for_if_none_match():
+    assert etag_matches('W/"f-3"', make_etag("f", 3))
+
+
+def test_tag_list_and_star():
+    assert etag_matches('"f-1", "f-3"', make_etag("f", 3))
+    assert etag_matches(' * ', make_etag("f", 3))
+
+
+@pytest.mark.parametrize("header", [None, "", '"f-2"', '"g-3"', 'f-3'])
+def test_other_tags_do_not_match(header):
+    assert not etag_matches(header, make_etag("f", 3))
+
+
+# ========== parse_etag_version (If-Match) ==========
+
+def test_version_from_strong_tag():
+    assert parse_etag_version('"f-3"', "f") == 3
+    assert parse_etag_version('  "f-0" ', "f") == 0
+
+
+def test_weak_tag_is_rejected():
+    # If-Match требует сильного сравнения
+    assert parse_etag_version('W/"f-3"', "f") is None
+
+
+@pytest.mark.parametrize("header", ['"g-3"', '"f-"', '"f-x"', '"f-3-1"', '"ff-3"'])
+def test_foreign_or_malformed_tag_is_rejected(header):
+    assert parse_etag_version(header, "f") is None
+
+
+def test_id_with_dashes():
+    file_id = "0b7c-4e1a-9d"
+    assert parse_etag_version(make_etag(file_id, 12), file_id) == 12
+
+
+# ========== make_listing_etag / version_filter ==========
+
+def test_listing_etag_depends_on_versions_order_and_variant():
+    docs = [{"id": "a", "version": 1}, {"id": "b", "version": 2}]
+    etag = make_listing_etag(docs)
+
+    assert etag == make_listing_etag([dict(d) for d in docs])
+    assert etag != make_listing_etag([docs[0], {"id": "b", "version": 3}])
+    assert etag != make_listing_etag(list(reversed(docs)))
+    assert etag != make_listing_etag(docs, variant="meta")
+
+
+def test_missing_version_is_zero():
+    assert make_listing_etag([{"id": "a"}]) == make_listing_etag([{"id": "a", "version": 0}])
+    assert version_filter(0) == {"version": {"$exists": False}}
+    assert version_filter(4) == {"version": 4}
@@ -0,0 +1,139 @@
+import pytest
+
+from server import (
+    FIX_CONTEXT_LINES,
+    FIX_WHOLE_FILE_LINES,
+    build_fix_context,
+    find_error_line,
+    replace_lines,
+)
+
+
+def make_file(path, line_count, overrides=None):
+    lines = [f"x_{n} = {n}" for n in range(1, line_count + 1)]
+    for number, text in (overrides or {}).items():
+        lines[number - 1] = text
+    return {"path": path, "content": "\n".join(lines) + "\n"}
+
+
+# ========== replace_lines ==========
+
+def test_replace_single_line_keeps_newline():
+    assert replace_lines("a\nb\nc\n", 2, 2, "B") == "a\nB\nc\n"
+
+
+def test_replace_several_lines_with_one():
+    assert replace_lines("a\nb\nc\nd\n", 2, 3, "X\n") == "a\nX\nd\n"
+
+
+def test_delete_lines():
+    assert replace_lines("a\nb\nc\n", 2, 2, "") == "a\nc\n"
+
+
+def test_insert_before_line():
+    # end_line = start_line - 1 - вставка перед start_line
+    assert replace_lines("a\nb\n", 2, 1, "x") == "a\nx\nb\n"
+    assert replace_lines("a\nb\n", 1, 0, "x") == "x\na\nb\n"
+
+
+def test_insert_at_end_of_file():
+    assert replace_lines("a\nb\n", 3, 2, "c") == "a\nb\nc\n"
+
+
+def test_insert_at_end_of_file_without_newline():
+    assert replace_lines("a\nb", 3, 2, "c") == "a\nb\nc"
+
+
+def test_replace_last_line_without_newline():
+    assert replace_lines("a\nb", 2, 2, "c") == "a\nc"
+    assert replace_lines("a\nb", 2, 2, "c\n") == "a\nc\n"
+
+
+def test_insert_into_empty_file():
+    assert replace_lines("", 1, 0, "x") == "x"
+
+
+@pytest.mark.parametrize("start, end", [(0, 1), (2, 0), (4, 4), (5, 4), (2, 4)])
+def test_invalid_range_is_rejected(start, end):
+    with pytest.raises(ValueError):
+        replace_lines("a\nb\nc\n", start, end, "x")
+
+
+# ========== find_error_line ==========
+
+@pytest.mark.parametrize("error, path, line", [
+    ("src/main.py:42:5: E999 SyntaxError", "src/main.py", 42),
+    ('File "/app/src/main.py", line 7, in <module>', "src/main.py", 7),
+    ("main.py (строка 12): не найден импорт", "src/main.py", 12),
+    ("main.py: стр. 9", "main.py", 9),
+    ("Ошибка на строке 15 в файле main.py", "main.py", 15),
+    ("NameError at line 3 in main.py", "main.py", 3),
+])
+def test_line_next_to_file_reference(error, path, line):
+    assert find_error_line(error, path) == line
+
+
+@pytest.mark.parametrize("error", [
+    "ошибка в 10:30 main.py",
+    "SyntaxError at line 3",
+    "test_main.py:5 assertion failed",
+    "main.py не импортирует модуль",
+])
+def test_numbers_not_next_to_file_are_ignored(error):
+    assert find_error_line(error, "main.py") is None
+
+
+# ========== build_fix_context ==========
+
+def test_small_file_is_sent_whole():
+    file = make_file("main.py", 5)
+    context = build_fix_context("main.py:3 ошибка", file, [file])
+
+    assert (context["start_line"], context["end_line"], context["total_lines"]) == (1, 5, 5)
+    assert context["code"].splitlines()[2] == "    3| x_3 = 3"
+    assert context["definitions"] == "нет"
+
+
+def test_window_around_error_line():
+    total = FIX_WHOLE_FILE_LINES + 100
+    line = FIX_WHOLE_FILE_LINES
+    file = make_file("main.py", total)
+    context = build_fix_context(f"main.py:{line}: ошибка", file, [file])
+
+    assert context["start_line"] == line - FIX_CONTEXT_LINES
+    assert context["end_line"] == line + FIX_CONTEXT_LINES
+    assert f"{line:>5}| x_{line} = {line}" in context["code"].splitlines()
+
+
+def test_window_is_clamped_to_file():
+    total = FIX_WHOLE_FILE_LINES + 10
+    file = make_file("main.py", total)
+    context = build_fix_context(f"main.py:{total}: ошибка", file, [file])
+
+    assert context["end_line"] == total
+    assert context["start_line"] == total - FIX_CONTEXT_LINES
+
+
+def test_window_anchored_on_quoted_symbol_without_line():
+    total = FIX_WHOLE_FILE_LINES + 100
+    line = FIX_WHOLE_FILE_LINES
+    file = make_file("main.py", total, {line: "result = load_config()"})
+    context = build_fix_context("ошибка в 10:30 main.py: 'load_config' is not defined", file, [file])
+
+    assert context["start_line"] == line - FIX_CONTEXT_LINES
+    assert context["end_line"] == line + FIX_CONTEXT_LINES
+
+
+def test_definitions_from_other_files():
+    file = make_file("main.py", 5, {2: "result = load_config()"})
+    config = {"path": "config.py", "content": "import os\n\ndef load_config():\n    return {}\n"}
+    context = build_fix_context("main.py:2 'load_config' is not defined", file, [file, config])
+
+    assert context["definitions"].startswith("# config.py:3\ndef load_config():")
+
+
+def test_definition_inside_window_is_not_repeated():
+    file = make_file("main.py", 5, {1: "def helper():", 4: "helper(1)"})
+    context = build_fix_context("main.py:4 'helper' takes 0 arguments", file, [file])
+
+    assert context["definitions"] == "нет"
@@ -0,0 +1,225 @@
+import pytest
+
+from server import TextEdit, apply_text_edits, apply_unified_diff
+
+
+def edit(start, end, text=""):
+    return TextEdit(start=start, end=end, text=text)
+
+
+# ========== apply_text_edits ==========
+
+def test_edits_apply_relative_to_original_text():
+    content = "hello world\n"
+    result = apply_text_edits(content, [edit(6, 11, "there"), edit(0, 5, "Hi")])
+    assert result == "Hi there\n"
+
+
+def test_insert_and_delete():
+    assert apply_text_edits("abc", [edit(1, 1, "X")]) == "aXbc"
+    assert apply_text_edits("abc", [edit(1, 2)]) == "ac"
+    assert apply_text_edits("abc", [edit(3, 3, "d")]) == "abcd"
+
+
+def test_adjacent_edits_are_allowed():
+    assert apply_text_edits("abcd", [edit(0, 2, "X"), edit(2, 4, "Y")]) == "XY"
+
+
+def test_overlapping_edits_are_rejected():
+    with pytest.raises(ValueError):
+        apply_text_edits("abcdef", [edit(0, 3, "X"), edit(2, 5, "Y")])
+
+
+def test_reversed_range_is_rejected():
+    with pytest.raises(ValueError):
+        apply_text_edits("abcdef", [edit(4, 2)])
+
+
+@pytest.mark.parametrize("start, end", [(0, 4), (-1, 0), (5, 5)])
+def test_out_of_range_offsets_are_rejected(start, end):
+    with pytest.raises(ValueError):
+        apply_text_edits("abc", [edit(start, end)])
+
+
+def test_offsets_are_utf16_code_units():
+    # "😀" занимает две кодовые единицы UTF-16, как в JavaScript
+    content = "a😀b"
+    assert apply_text_edits(content, [edit(3, 4, "c")]) == "a😀c"
+    assert apply_text_edits(content, [edit(1, 3, "-")]) == "a-b"
+    assert apply_text_edits(content, [edit(4, 4, "!")]) == "a😀b!"
+
+
+def test_offset_inside_surrogate_pair_is_rejected():
+    with pytest.raises(ValueError):
+        apply_text_edits("a😀b", [edit(2, 3)])
+
+
+# ========== apply_unified_diff ==========
+
+def test_diff_replaces_line():
+    diff = (
+        "--- a/main.py\n"
+        "+++ b/main.py\n"
+        "@@ -1,3 +1,3 @@\n"
+        " a\n"
+        "-b\n"
+        "+B\n"
+        " c\n"
+    )
+    assert apply_unified_diff("a\nb\nc\n", diff) == "a\nB\nc\n"
+
+
+def test_diff_with_several_hunks():
+    content = "".join(f"{i}\n" for i in range(1, 11))
+    diff = (
+        "@@ -2 +2 @@\n"
+        "-2\n"
+        "+two\n"
+        "@@ -9,2 +9,2 @@\n"
+        " 9\n"
+        "-10\n"
+        "+ten\n"
+    )
+    expected = content.replace("2\n", "two\n", 1).replace("10\n", "ten\n")
+    assert apply_unified_diff(content, diff) == expected
+
+
+def test_no_newline_marker_on_added_line():
+    diff = (
+        "@@ -1,2 +1,2 @@\n"
+        " a\n"
+        "-b\n"
+        "+c\n"
+        "\\ No newline at end of file\n"
+    )
+    assert apply_unified_diff("a\nb\n", diff) == "a\nc"
+
+
+def test_no_newline_marker_on_both_sides():
+    diff = (
+        "@@ -1,2 +1,2 @@\n"
+        " a\n"
+        "-b\n"
+        "\\ No newline at end of file\n"
+        "+c\n"
+        "\\ No newline at end of file\n"
+    )
+    assert apply_unified_diff("a\nb", diff) == "a\nc"
+
+
+def test_no_newline_marker_on_removed_line_adds_newline():
+    diff = (
+        "@@ -2 +2 @@\n"
+        "-b\n"
+        "\\ No newline at end of file\n"
+        "+b\n"
+    )
+    assert apply_unified_diff("a\nb", diff) == "a\nb\n"
+
+
+def test_zero_length_hunk_inserts_after_line():
+    diff = (
+        "@@ -1,0 +2 @@\n"
+        "+x\n"
+    )
+    assert apply_unified_diff("a\nb\n", diff) == "a\nx\nb\n"
+
+
+def test_zero_length_hunk_at_start_of_file():
+    diff = (
+        "@@ -0,0 +1 @@\n"
+        "+x\n"
+    )
+    assert apply_unified_diff("a\nb\n", diff) == "x\na\nb\n"
+
+
+def test_pure_deletion_hunk():
+    diff = (
+        "@@ -2 +1,0 @@\n"
+        "-b\n"
+    )
+    assert apply_unified_diff("a\nb\nc\n", diff) == "a\nc\n"
+
+
+def test_context_mismatch_is_rejected():
+    diff = (
+        "@@ -1,2 +1,2 @@\n"
+        " a\n"
+        "-x\n"
+        "+y\n"
+    )
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\n", diff)
+
+
+def test_hunk_past_end_of_file_is_rejected():
+    diff = (
+        "@@ -5 +5 @@\n"
+        "-e\n"
+        "+E\n"
+    )
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\n", diff)
+
+
+def test_hunks_out_of_order_are_rejected():
+    diff = (
+        "@@ -3 +3 @@\n"
+        "-c\n"
+        "+C\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+A\n"
+    )
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\nc\n", diff)
+
+
+def test_truncated_hunk_is_rejected():
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\nc\n", "@@ -1,3 +1,3 @@\n a\n-b\n")
+
+
+def test_truncated_hunk_before_next_hunk_is_rejected():
+    diff = (
+        "@@ -1,2 +1,2 @@\n"
+        "-a\n"
+        "@@ -3 +3 @@\n"
+        "-c\n"
+        "+C\n"
+    )
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\nc\n", diff)
+
+
+@pytest.mark.parametrize("extra", [" c\n", "-c\n", "+d\n"])
+def test_hunk_longer_than_header_is_rejected(extra):
+    diff = (
+        "@@ -1,2 +1,2 @@\n"
+        " a\n"
+        "-b\n"
+        "+B\n"
+    ) + extra
+    with pytest.raises(ValueError):
+        apply_unified_diff("a\nb\nc\n", diff)
+
+
+def test_trailing_blank_line_after_hunk_is_ignored():
+    diff = (
+        "@@ -2 +2 @@\n"
+        "-b\n"
+        "+B\n"
+        "\n"
+    )
+    assert apply_unified_diff("a\nb\nc\n", diff) == "a\nB\nc\n"
+
+
+def test_blank_context_line_without_leading_space():
+    diff = (
+        "@@ -1,3 +1,3 @@\n"
+        " a\n"
+        "\n"
+        "-c\n"
+        "+C\n"
+    )
+    assert apply_unified_diff("a\n\nc\n", diff) == "a\n\nC\n"